@@ -0,0 +1,107 @@
+"""
+Compare the dir and archive layouts of exported json: load time of all songs and disk footprint.
+
+    python -m bench.archive --albums 2000 --album-size 12 --workers 0,4
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from pathlib import Path
+from .mock_server import Library
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from xiami_exporter.config import Config  # NOQA
+from xiami_exporter.store import FileStore, COLLECTIONS, get_json_backend  # NOQA
+
+
+def make_config(dir_path, backend):
+    cfg = Config()
+    cfg.dir_path = Path(dir_path)
+    cfg.json_backend = backend
+    return cfg
+
+
+def write_exports(cfg, library: Library, page_size=100):
+    docs = get_json_backend(cfg, 'dir')
+    songs = library.songs
+    for i in range(0, len(songs), page_size):
+        docs.save('songs', f'songs-{i // page_size + 1}', songs[i:i + page_size])
+    for album_id, album in library.albums.items():
+        docs.save('albums/details', album_id, album)
+    for list_id, playlist in library.playlists.items():
+        docs.save('my_playlists/details', list_id, playlist)
+
+
+def footprint(dir_path):
+    """
+    (number of files, apparent bytes, allocated bytes)
+    """
+    count, size, allocated = 0, 0, 0
+    for root, _, files in os.walk(dir_path):
+        for name in files:
+            st = os.stat(os.path.join(root, name))
+            count += 1
+            size += st.st_size
+            allocated += st.st_blocks * 512
+    return count, size, allocated
+
+
+def measure_load(cfg, repeat, workers=0):
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        songs = FileStore(cfg).load_all_song_json(workers=workers)
+        times.append(time.perf_counter() - t0)
+    return min(times), len(songs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark json layouts')
+    parser.add_argument('--albums', type=int, default=1000)
+    parser.add_argument('--album-size', type=int, default=12)
+    parser.add_argument('--playlists', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of loading, the fastest is reported')
+    parser.add_argument('--workers', default='0', help='numbers of loader processes to compare, comma separated')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix='xme-archive-'))
+    try:
+        library = Library('http://127.0.0.1', songs=args.albums * args.album_size,
+                          album_size=args.album_size, playlists=args.playlists, audio_frames=1)
+        dir_cfg = make_config(work_dir, 'dir')
+        archive_cfg = make_config(work_dir, 'archive')
+
+        t0 = time.perf_counter()
+        write_exports(dir_cfg, library)
+        print(f'write dir layout: {time.perf_counter() - t0:.2f}s')
+
+        t0 = time.perf_counter()
+        src, dst = get_json_backend(dir_cfg), get_json_backend(archive_cfg)
+        for collection in COLLECTIONS:
+            for key, data in src.iter_items(collection):
+                dst.save(collection, key, data)
+        print(f'convert to archive: {time.perf_counter() - t0:.2f}s')
+
+        print(f'cpus: {os.cpu_count()}, workers are capped by it')
+        print(f'{"layout":<10}{"files":>8}{"bytes":>14}{"allocated":>14}{"workers":>9}{"load s":>10}{"songs":>9}')
+        for cfg, dir_path in [(dir_cfg, dir_cfg.json_dir), (archive_cfg, archive_cfg.json_archive_dir)]:
+            count, size, allocated = footprint(dir_path)
+            for workers in [int(i) for i in args.workers.split(',')]:
+                seconds, songs = measure_load(cfg, args.repeat, workers)
+                print(f'{cfg.json_backend:<10}{count:>8}{size:>14}{allocated:>14}{workers:>9}{seconds:>10.3f}{songs:>9}')
+    finally:
+        if args.keep:
+            print(f'working directory: {work_dir}')
+        else:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
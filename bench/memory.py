@@ -0,0 +1,133 @@
+"""
+Memory of bulk read paths: Song models vs named tuples of the needed columns, and full vs projected song json.
+
+    python -m bench.memory --songs 100000 --json-songs 20000
+"""
+import gc
+import sys
+import time
+import json
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT_DIR))
+
+from xiami_exporter.config import Config  # NOQA
+from xiami_exporter.models import db, Song, DownloadStatus  # NOQA
+from xiami_exporter.store import FileStore, get_json_backend  # NOQA
+from xiami_exporter.id3 import TAG_FIELDS  # NOQA
+
+
+def load_song_templates():
+    with open(ROOT_DIR.joinpath('refs', 'songs_raw.json')) as f:
+        return json.loads(f.read())['result']['data']['songs']
+
+
+def make_song_row(template, i):
+    row = {}
+    for field in Song._meta.sorted_fields:
+        if field.help_text:
+            v = template.get(field.help_text)
+            row[field.name] = '' if v is None else v
+    row.update(
+        id=1000000 + i, sid=f's{1000000 + i}', row_number=i + 1, album_id=100 + i // 10, artist_id=500 + i // 30,
+        sub_name='', download_status=DownloadStatus.NOT_SET, in_songs=True,
+    )
+    return row
+
+
+def create_db(db_path, count):
+    db.init(str(db_path))
+    db.create_tables([Song])
+    templates = load_song_templates()
+    with db.atomic():
+        rows = []
+        for i in range(count):
+            rows.append(make_song_row(templates[i % len(templates)], i))
+            if len(rows) == 500:
+                Song.insert_many(rows).execute()
+                rows = []
+        if rows:
+            Song.insert_many(rows).execute()
+
+
+def write_json(cfg, count, page_size=100):
+    templates = load_song_templates()
+    docs = get_json_backend(cfg)
+    for page in range(0, count, page_size):
+        songs = []
+        for i in range(page, min(page + page_size, count)):
+            song = dict(templates[i % len(templates)])
+            song.update(songId=1000000 + i, songStringId=f's{1000000 + i}')
+            songs.append(song)
+        docs.save('songs', f'songs-{page // page_size + 1}', songs)
+
+
+def measure(fn):
+    """
+    Returns (seconds, retained bytes of the result, peak bytes while building it)
+    """
+    gc.collect()
+    t0 = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - t0
+    del result
+    gc.collect()
+
+    tracemalloc.start()
+    result = fn()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return seconds, current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark memory of bulk read paths')
+    parser.add_argument('--songs', type=int, default=100000, help='songs in the database')
+    parser.add_argument('--json-songs', type=int, default=20000, help='songs in exported json')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    args = parser.parse_args()
+
+    work_dir = Path(tempfile.mkdtemp(prefix='xme-memory-'))
+    try:
+        cfg = Config()
+        cfg.dir_path = work_dir
+
+        t0 = time.perf_counter()
+        create_db(work_dir.joinpath('db.sqlite3'), args.songs)
+        write_json(cfg, args.json_songs)
+        print(f'create {args.songs} songs in db, {args.json_songs} songs in json: {time.perf_counter() - t0:.2f}s')
+
+        tag_columns = [getattr(Song, i) for i in TAG_FIELDS]
+        fs = FileStore(cfg)
+        cases = [
+            ('db: Song models', lambda: list(Song.select())),
+            (f'db: {len(tag_columns)} tag columns, namedtuples', lambda: list(Song.select(*tag_columns).namedtuples())),
+            ('db: cover columns, namedtuples',
+             lambda: list(Song.select(Song.id, Song.album_id, Song.artist_id).namedtuples())),
+            ('db: id, namedtuples', lambda: list(Song.select(Song.id).namedtuples())),
+            ('json: full songs', lambda: fs.load_all_song_json(workers=0)),
+            ('json: albumLogo, artistLogo', lambda: fs.load_all_song_json(workers=0, fields=['albumLogo', 'artistLogo'])),
+        ]
+        print(f'{"case":<40}{"seconds":>9}{"retained MB":>13}{"peak MB":>10}{"bytes/song":>12}')
+        for name, fn in cases:
+            seconds, current, peak = measure(fn)
+            count = args.json_songs if name.startswith('json') else args.songs
+            print(f'{name:<40}{seconds:>9.3f}{current / 1024 / 1024:>13.1f}{peak / 1024 / 1024:>10.1f}'
+                  f'{current // max(count, 1):>12}')
+    finally:
+        db.close()
+        if args.keep:
+            print(f'working directory: {work_dir}')
+        else:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,354 @@
+"""
+A local stand-in for the xiami api and cdn, serving data generated from refs/*.json.
+
+Run standalone:
+
+    python -m bench.mock_server --port 8765 --songs 1000 --latency 0.05 --error-rate 0.01
+"""
+import io
+import copy
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs, urlencode
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from http.cookies import SimpleCookie
+
+
+lg = logging.getLogger('bench.mock_server')
+
+REFS_DIR = Path(__file__).resolve().parent.parent.joinpath('refs')
+
+TOKEN_PREFIX = 'be5bb12dbb135066f4cb282706019bc8'
+
+# MPEG-1 Layer III, 128kbps, 44.1kHz, no padding, no crc
+MP3_FRAME_HEADER = b'\xff\xfb\x90\x00'
+MP3_FRAME_SIZE = 144 * 128000 // 44100
+
+
+def make_token(tk, path, q_json):
+    v = tk.split('_')[0] + '_xmMain_' + path + '_' + q_json
+    return hashlib.md5(v.encode()).hexdigest()
+
+
+def make_mp3(frames):
+    frame = MP3_FRAME_HEADER + b'\x00' * (MP3_FRAME_SIZE - len(MP3_FRAME_HEADER))
+    return frame * frames
+
+
+def make_cover(size=300):
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new('RGB', (size, size), (200, 80, 80)).save(buf, format='JPEG')
+    return buf.getvalue()
+
+
+class Library:
+    """
+    Fake account data: songs, albums and playlists, cloned from the fixtures in refs/
+    """
+    def __init__(self, base_url, songs=300, album_size=10, playlists=5, playlist_size=50, audio_frames=240):
+        self.base_url = base_url
+        with open(REFS_DIR.joinpath('songs_raw.json')) as f:
+            song_templates = json.loads(f.read())['result']['data']['songs']
+        with open(REFS_DIR.joinpath('playinfo.json')) as f:
+            self.playinfo_template = json.loads(f.read())['result']['data']['songPlayInfos'][0]['playInfos']
+
+        self.audio = make_mp3(audio_frames)
+        self.cover = make_cover()
+
+        self.songs = []
+        self.albums = {}
+        for i in range(songs):
+            song = copy.deepcopy(song_templates[i % len(song_templates)])
+            song_id = 1000000 + i
+            album_id = 100 + i // album_size
+            artist_id = 500 + i // (album_size * 3)
+            song.update({
+                'songId': song_id,
+                'songStringId': f's{song_id}',
+                'albumId': album_id,
+                'albumStringId': f'a{album_id}',
+                'albumName': f'Album {album_id}',
+                'albumLogo': f'{base_url}/cdn/covers/{album_id}.jpg',
+                'artistId': artist_id,
+                'artistLogo': f'{base_url}/cdn/artists/{artist_id}.jpg',
+                'track': i % album_size + 1,
+                'bakSongId': 0,
+            })
+            if song.get('lyricInfo'):
+                song['lyricInfo'] = dict(song['lyricInfo'], lyricFile=f'{base_url}/cdn/lyrics/{song_id}.lrc')
+            self.songs.append(song)
+            album = self.albums.setdefault(album_id, {
+                'albumId': album_id,
+                'albumStringId': f'a{album_id}',
+                'albumName': f'Album {album_id}',
+                'albumLogo': f'{base_url}/cdn/covers/{album_id}.jpg',
+                'artistId': artist_id,
+                'artistName': song['artistName'],
+                'songs': [],
+            })
+            album['songs'].append(song)
+        self.songs_dict = {i['songId']: i for i in self.songs}
+
+        self.playlists = {}
+        for i in range(playlists):
+            list_id = 9000 + i
+            start = i * playlist_size % max(songs, 1)
+            self.playlists[list_id] = {
+                'listId': list_id,
+                'collectName': f'Playlist {list_id}',
+                'type': 0,
+                'songs': (self.songs + self.songs)[start:start + playlist_size],
+            }
+
+        self.artists = []
+        for song in self.songs:
+            if not self.artists or self.artists[-1]['artistId'] != song['artistId']:
+                self.artists.append({
+                    'artistId': song['artistId'],
+                    'artistName': song['artistName'],
+                    'artistLogo': song['artistLogo'],
+                })
+
+    def page(self, items, q):
+        paging = q.get('pagingVO', {})
+        page, page_size = paging.get('page', 1), paging.get('pageSize', 30)
+        rv = items[(page - 1) * page_size:page * page_size]
+        # when out of max page, the api returns null
+        return rv or None
+
+    def album_brief(self, album):
+        return {k: v for k, v in album.items() if k != 'songs'}
+
+    def playlist_brief(self, pl):
+        return {k: v for k, v in pl.items() if k != 'songs'}
+
+    def playinfo(self, song_id):
+        infos = []
+        for tpl in self.playinfo_template:
+            info = dict(tpl)
+            info['listenFile'] = f'{self.base_url}/cdn/audio/{song_id}_{info["quality"]}.mp3?expire=86400'
+            info['fileSize'] = len(self.audio) if info['listenFile'] else 0
+            infos.append(info)
+        return {'songId': song_id, 'playInfos': infos}
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes_sent = 0
+            self.errors = 0
+            self.by_path = {}
+
+    def add(self, path, size, error=False):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += size
+            if error:
+                self.errors += 1
+            self.by_path[path] = self.by_path.get(path, 0) + 1
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'bytes_sent': self.bytes_sent,
+                'errors': self.errors,
+                'by_path': dict(self.by_path),
+            }
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, library_kwargs=None, latency=0, error_rate=0, error_prefix='', token_ttl=0, seed=0):
+        super().__init__(address, MockHandler)
+        self.base_url = f'http://{self.server_address[0]}:{self.server_address[1]}'
+        self.library = Library(self.base_url, **(library_kwargs or {}))
+        # seconds to sleep before responding
+        self.latency = latency
+        # ratio of responses that are 500 errors
+        self.error_rate = error_rate
+        # only inject errors for paths starting with this prefix
+        self.error_prefix = error_prefix
+        # number of api requests after which the token expires, 0 means never
+        self.token_ttl = token_ttl
+        self.random = random.Random(seed)
+        self.stats = Stats()
+        self.token_lock = threading.Lock()
+        self.token = f'{TOKEN_PREFIX}_0'
+        self.token_uses = 0
+
+    def use_token(self, tk):
+        """
+        returns response code for the token
+        """
+        with self.token_lock:
+            if not tk:
+                return 'SG_TOKEN_EMPTY'
+            if tk != self.token:
+                return 'SG_TOKEN_EXPIRED'
+            self.token_uses += 1
+            if self.token_ttl and self.token_uses > self.token_ttl:
+                self.token = f'{TOKEN_PREFIX}_{int(time.time() * 1000)}'
+                self.token_uses = 0
+                return 'SG_TOKEN_EXPIRED'
+            return 'SUCCESS'
+
+    def serve_in_thread(self):
+        t = threading.Thread(target=self.serve_forever, daemon=True)
+        t.start()
+        return t
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    server: MockServer
+
+    def log_message(self, format, *args):
+        lg.debug(format, *args)
+
+    def send_body(self, body: bytes, content_type='application/json', status=200, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+        path = urlparse(self.path).path
+        if not path.startswith('/__'):
+            self.server.stats.add(path, len(body), error=status >= 400)
+
+    def send_json(self, data, headers=None):
+        self.send_body(json.dumps(data, ensure_ascii=False).encode(), headers=headers)
+
+    def send_result(self, data):
+        self.send_json({'code': 'SUCCESS', 'result': {'status': 'SUCCESS', 'data': data}})
+
+    def do_GET(self):
+        server = self.server
+        url_parsed = urlparse(self.path)
+        path = url_parsed.path
+        params = {k: v[0] for k, v in parse_qs(url_parsed.query).items()}
+
+        if path == '/__stats':
+            return self.send_json(server.stats.to_dict())
+
+        if server.latency:
+            time.sleep(server.latency)
+        if server.error_rate and path.startswith(server.error_prefix) and server.random.random() < server.error_rate:
+            return self.send_body(b'internal error', content_type='text/plain', status=500)
+
+        if path.startswith('/api/'):
+            return self.handle_api(path, params)
+        if path.startswith('/static/collect/'):
+            list_id = int(path.split('/')[-1].split('.')[0])
+            return self.send_json({'resultObj': server.library.playlists[list_id]})
+        if path.startswith('/cdn/audio/'):
+            return self.send_body(server.library.audio, content_type='audio/mpeg')
+        if path.startswith('/cdn/lyrics/'):
+            song_id = int(path.split('/')[-1].split('.')[0])
+            song = server.library.songs_dict[song_id]
+            lrc = f'[ti:{song["songName"]}]\n[ar:{song["artistName"]}]\n[00:01.00]<0>la <300>la\n[00:05.00]{song_id}\n'
+            return self.send_body(lrc.encode('utf8'), content_type='text/plain')
+        if path.startswith('/cdn/covers/') or path.startswith('/cdn/artists/'):
+            return self.send_body(server.library.cover, content_type='image/jpeg')
+        self.send_body(b'not found', content_type='text/plain', status=404)
+
+    def handle_api(self, path, params):
+        server = self.server
+        lib = server.library
+
+        cookie = SimpleCookie(self.headers.get('Cookie', ''))
+        tk = cookie['xm_sg_tk'].value if 'xm_sg_tk' in cookie else ''
+        code = server.use_token(tk)
+        if code != 'SUCCESS':
+            return self.send_json(
+                {'code': code, 'msg': '令牌过期'},
+                headers={'Set-Cookie': f'xm_sg_tk={server.token}; Path=/'})
+
+        q_json = params.get('_q', '')
+        if params.get('_s') != make_token(tk, path, q_json):
+            return self.send_json({'code': 'SG_INVALID', 'msg': '请求无效'})
+        q = json.loads(q_json) if q_json else {}
+
+        if path == '/api/favorite/getFavorites':
+            fav_type = q.get('type')
+            if fav_type == 1:
+                return self.send_result({'songs': lib.page(lib.songs, q)})
+            if fav_type == 2:
+                albums = [lib.album_brief(i) for i in lib.albums.values()]
+                return self.send_result({'albums': lib.page(albums, q)})
+            if fav_type == 3:
+                return self.send_result({'artists': lib.page(lib.artists, q)})
+            if fav_type == 5:
+                pls = [lib.playlist_brief(i) for i in lib.playlists.values()]
+                return self.send_result({'collects': lib.page(pls, q)})
+        elif path == '/api/collect/getCollectByUser':
+            pls = [lib.playlist_brief(i) for i in lib.playlists.values()]
+            return self.send_result({'collects': lib.page(pls, q)})
+        elif path == '/api/song/getPlayInfo':
+            infos = [lib.playinfo(i) for i in q['songIds'] if int(i) in lib.songs_dict]
+            return self.send_result({'songPlayInfos': infos})
+        elif path == '/api/album/getAlbumDetailNormal':
+            return self.send_result({'albumDetail': lib.albums[int(q['albumId'])]})
+        elif path == '/api/collect/getCollectStaticUrl':
+            url = f'{server.base_url}/static/collect/{q["listId"]}.json'
+            return self.send_result({'data': {'data': {'url': url}}})
+        self.send_json({'code': 'NOT_FOUND'})
+
+
+def make_fetch_js(base_url, token):
+    """
+    Generate fetch.py content in the format of Chrome "Copy as Node.js fetch"
+    """
+    path = '/api/favorite/getFavorites'
+    q_json = json.dumps({'userId': 1, 'type': 1, 'pagingVO': {'page': 1, 'pageSize': 1}}, separators=(',', ':'))
+    s = make_token(token, path, q_json)
+    url = f'{base_url}{path}?' + urlencode({'_q': q_json, '_s': s})
+    args = {
+        'headers': {
+            'accept': 'application/json, text/plain, */*',
+            'cookie': f'xm_sg_tk={token}; xm_sg_tk.sig=mock',
+        },
+        'referrer': f'{base_url}/user/1',
+        'body': None,
+        'method': 'GET',
+    }
+    return f'fetch({json.dumps(url)}, {json.dumps(args, indent=2)});\n'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='mock xiami server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--songs', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--error-prefix', default='', help='e.g. /cdn/ to only inject errors for cdn files')
+    parser.add_argument('--token-ttl', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG)
+    server = MockServer(
+        (args.host, args.port), library_kwargs={'songs': args.songs},
+        latency=args.latency, error_rate=args.error_rate, error_prefix=args.error_prefix,
+        token_ttl=args.token_ttl)
+    print(f'serving on {server.base_url}')
+    print(f'fetch.py:\n{make_fetch_js(server.base_url, server.token)}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
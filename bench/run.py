@@ -0,0 +1,140 @@
+"""
+End-to-end throughput benchmark, runs each cli command against the local mock server.
+
+    python -m bench.run --songs 500 --latency 0.02 --error-rate 0.01 --output bench_output.txt
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from .mock_server import MockServer, make_fetch_js
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+COMMANDS = [
+    ['export', 'SONGS'],
+    ['export', 'ALBUMS'],
+    ['export', 'ARTISTS'],
+    ['export', 'PLAYLISTS'],
+    ['export', 'MY_PLAYLISTS'],
+    ['export', 'ALBUMS', '-c'],
+    ['export', 'PLAYLISTS', '-c'],
+    ['export', 'MY_PLAYLISTS', '-c'],
+    ['create-songs-db'],
+    ['create-song-list-db', 'ALBUM'],
+    ['create-song-list-db', 'PLAYLIST'],
+    ['download-music'],
+    ['download-music', '-t'],
+    ['download-covers'],
+    ['tag-music'],
+    ['collect-song-lists'],
+]
+
+
+def prepare_workdir(work_dir: Path, base_url, token):
+    config = {
+        'dir_path': str(work_dir.joinpath('XiamiExports')),
+        'user_id': '1',
+        'wait_time': 0,
+        'proxy_url': '',
+        'base_url': base_url,
+    }
+    with open(work_dir.joinpath('config.json'), 'w') as f:
+        f.write(json.dumps(config, indent=2))
+    with open(work_dir.joinpath('fetch.py'), 'w') as f:
+        f.write(make_fetch_js(base_url, token))
+
+
+def run_command(args, work_dir, verbose=False):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = str(ROOT_DIR)
+    env['NO_PROXY'] = '127.0.0.1,localhost'
+    env.pop('XME_DIR_PATH', None)
+    cmd = [sys.executable, '-m', 'xiami_exporter.cli'] + args
+    out = None if verbose else subprocess.DEVNULL
+    t0 = time.perf_counter()
+    p = subprocess.run(cmd, cwd=work_dir, env=env, stdout=out, stderr=out)
+    return time.perf_counter() - t0, p.returncode
+
+
+def format_row(cols, widths):
+    return '  '.join(str(c).ljust(w) for c, w in zip(cols, widths))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark cli commands against the mock server')
+    parser.add_argument('--songs', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0, help='seconds of latency per request')
+    parser.add_argument('--error-rate', type=float, default=0, help='ratio of 500 responses')
+    parser.add_argument('--error-prefix', default='', help='only inject errors for paths starting with this prefix')
+    parser.add_argument('--token-ttl', type=int, default=0, help='expire token after N api requests')
+    parser.add_argument('--commands', default='', help='only run commands whose name contains any of these, comma separated')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('--verbose', '-v', action='store_true', help='show output of commands')
+    parser.add_argument('--output', '-o', default='', help='write results as json to this file')
+    args = parser.parse_args()
+
+    server = MockServer(
+        ('127.0.0.1', 0), library_kwargs={'songs': args.songs},
+        latency=args.latency, error_rate=args.error_rate, error_prefix=args.error_prefix,
+        token_ttl=args.token_ttl)
+    server.serve_in_thread()
+
+    work_dir = Path(tempfile.mkdtemp(prefix='xme-bench-'))
+    prepare_workdir(work_dir, server.base_url, server.token)
+    print(f'mock server: {server.base_url}, work dir: {work_dir}')
+
+    filters = [i for i in args.commands.split(',') if i]
+    headers = ['command', 'rc', 'wall(s)', 'requests', 'req/s', 'MB', 'MB/s', 'errors']
+    widths = [36, 3, 8, 9, 8, 8, 8, 6]
+    print(format_row(headers, widths))
+    results = []
+    for cmd in COMMANDS:
+        name = ' '.join(cmd)
+        if filters and not any(i in name for i in filters):
+            continue
+        # the token may be expired by --token-ttl, make fetch.py up to date like a user would do
+        prepare_workdir(work_dir, server.base_url, server.token)
+        server.stats.reset()
+        wall, rc = run_command(cmd, work_dir, args.verbose)
+        stats = server.stats.to_dict()
+        mb = stats['bytes_sent'] / 1024 / 1024
+        result = {
+            'command': name,
+            'returncode': rc,
+            'wall_time': wall,
+            'requests': stats['requests'],
+            'requests_per_sec': stats['requests'] / wall,
+            'mb': mb,
+            'mb_per_sec': mb / wall,
+            'errors': stats['errors'],
+            'by_path': stats['by_path'],
+        }
+        results.append(result)
+        print(format_row([
+            name, rc, f'{wall:.2f}', stats['requests'], f'{result["requests_per_sec"]:.1f}',
+            f'{mb:.2f}', f'{result["mb_per_sec"]:.2f}', stats['errors'],
+        ], widths))
+
+    total_wall = sum(i['wall_time'] for i in results)
+    print(f'total wall time: {total_wall:.2f}s')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps({'args': vars(args), 'results': results}, indent=2))
+
+    server.shutdown()
+    if args.keep:
+        print(f'keep work dir: {work_dir}')
+    else:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
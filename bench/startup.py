@@ -0,0 +1,100 @@
+"""
+Startup time benchmark, measures the import cost each cli command pays before its body runs.
+
+Each command is run with --help under `python -X importtime`, so only module level imports are loaded:
+
+    python -m bench.startup --repeat 5 --output startup.json
+    python -m bench.startup --compare startup.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+# third-party packages that are slow to import, and should only be loaded by commands that use them
+HEAVY_PACKAGES = ['requests', 'peewee', 'mutagen', 'PIL']
+
+
+def get_commands():
+    sys.path.insert(0, str(ROOT_DIR))
+    from xiami_exporter.cli import cli
+    return sorted(cli.commands)
+
+
+def parse_importtime(stderr: str):
+    """
+    Returns (total import time in seconds, set of top level packages imported)
+    """
+    total_us = 0
+    packages = set()
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        total_us += int(self_us)
+        packages.add(name.strip().split('.')[0])
+    return total_us / 1000000, packages
+
+
+def measure(command, repeat):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = str(ROOT_DIR)
+    cmd = [sys.executable, '-X', 'importtime', '-m', 'xiami_exporter.cli', command, '--help']
+    walls, imports = [], []
+    packages = set()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        p = subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        walls.append(time.perf_counter() - t0)
+        if p.returncode != 0:
+            raise RuntimeError(f'{command} exited with {p.returncode}')
+        import_seconds, packages = parse_importtime(p.stderr)
+        imports.append(import_seconds)
+    return {
+        'command': command,
+        'wall': statistics.median(walls),
+        'import': statistics.median(imports),
+        'heavy': [i for i in HEAVY_PACKAGES if i in packages],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark startup time of cli commands')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per command, the median is reported')
+    parser.add_argument('--commands', default='', help='only run these commands, comma separated')
+    parser.add_argument('--compare', default='', help='json output of a previous run to compare with')
+    parser.add_argument('--output', '-o', default='', help='write results as json to this file')
+    args = parser.parse_args()
+
+    commands = get_commands()
+    if args.commands:
+        commands = [i for i in commands if i in args.commands.split(',')]
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = {i['command']: i for i in json.load(f)}
+
+    results = []
+    print(f'{"command":<22}{"wall ms":>9}{"import ms":>11}{"delta ms":>10}  heavy imports')
+    for command in commands:
+        r = measure(command, args.repeat)
+        results.append(r)
+        delta = ''
+        if command in previous:
+            delta = f'{(r["wall"] - previous[command]["wall"]) * 1000:+.1f}'
+        print(f'{command:<22}{r["wall"] * 1000:>9.1f}{r["import"] * 1000:>11.1f}{delta:>10}  {",".join(r["heavy"])}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
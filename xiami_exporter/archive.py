@@ -0,0 +1,214 @@
+"""
+Compressed archive of json documents, an alternative to one json file per page or detail.
+
+A collection is stored in two files:
+
+- ``<name>.jsonl.gz``: append-only data, each document is a gzip member of one json line
+  ``{"key": ..., "data": ...}``, so ``zcat`` of the file is valid JSON Lines
+- ``<name>.idx``: append-only index, a line of ``key<TAB>offset<TAB>length`` for each document
+
+A document that is saved again is appended, the last index entry of a key wins.
+``compact`` rewrites the collection without the stale documents into ``<name>.<generation>.jsonl.gz``,
+the index is then replaced with one whose header line ``#data<TAB><file name>`` names the new data file,
+so that the index and the data it points to are switched by a single rename.
+"""
+import os
+import gzip
+import json
+import logging
+from typing import Dict, Tuple, List, Iterator
+from .os_util import ensure_dir, file_number_key
+from .profiling import span
+
+
+lg = logging.getLogger('xiami.archive')
+
+
+class JsonArchive:
+    def __init__(self, dir_path, name, compresslevel=6):
+        self.dir_path = dir_path
+        self.name = name
+        self.compresslevel = compresslevel
+        self.index_path = os.path.join(dir_path, f'{name}.idx')
+        self._index = None
+        # set by the header of index, data file of an archive that is never compacted is <name>.jsonl.gz
+        self._generation = 0
+
+    def get_data_path(self, generation):
+        if generation:
+            return os.path.join(self.dir_path, f'{self.name}.{generation}.jsonl.gz')
+        return os.path.join(self.dir_path, f'{self.name}.jsonl.gz')
+
+    @property
+    def data_path(self):
+        # the generation is read from the header of index
+        if self._index is None:
+            self._index = self.read_index()
+        return self.get_data_path(self._generation)
+
+    @property
+    def index(self) -> Dict[str, Tuple[int, int]]:
+        """
+        key -> (offset, length) of the document in data file
+        """
+        if self._index is None:
+            self._index = self.read_index()
+        return self._index
+
+    def read_index(self):
+        index = {}
+        self._generation = 0
+        try:
+            f = open(self.index_path, 'r')
+        except FileNotFoundError:
+            return index
+        with f:
+            for line in f:
+                parts = line.rstrip('\n').split('\t')
+                if parts[0] == '#data' and len(parts) == 2:
+                    self._generation = self.parse_generation(parts[1])
+                    continue
+                if len(parts) != 3:
+                    # the last line is incomplete if a write is interrupted
+                    lg.warning(f'{self.index_path}: skip broken index line {line!r}')
+                    continue
+                index[parts[0]] = (int(parts[1]), int(parts[2]))
+        return index
+
+    def parse_generation(self, data_file_name):
+        middle = data_file_name[len(self.name) + 1:-len('.jsonl.gz')]
+        return int(middle) if middle.isdigit() else 0
+
+    def keys(self) -> List[str]:
+        """
+        Keys sorted by number in them, the same order as files sorted by os_util.dir_files_sorted
+        """
+        return sorted(self.index, key=file_number_key)
+
+    def __contains__(self, key):
+        return str(key) in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def load(self, key):
+        offset, length = self.index[str(key)]
+        with open(self.data_path, 'rb') as f:
+            f.seek(offset)
+            return self.decode(f.read(length))
+
+    def decode(self, b: bytes):
+        with span('json'):
+            return json.loads(gzip.decompress(b))['data']
+
+    def load_raw(self, key) -> bytes:
+        """
+        Returns the decompressed json line of the document, which is {"key": ..., "data": ...}
+        """
+        offset, length = self.index[str(key)]
+        with open(self.data_path, 'rb') as f:
+            f.seek(offset)
+            return gzip.decompress(f.read(length))
+
+    def size(self):
+        return sum(os.path.getsize(i) for i in (self.data_path, self.index_path) if os.path.exists(i))
+
+    def encode(self, key, data) -> bytes:
+        line = json.dumps({'key': key, 'data': data}, ensure_ascii=False) + '\n'
+        return gzip.compress(line.encode('utf8'), compresslevel=self.compresslevel, mtime=0)
+
+    def save(self, key, data):
+        key = str(key)
+        b = self.encode(key, data)
+        ensure_dir(self.dir_path)
+        with open(self.data_path, 'ab') as f:
+            offset = f.tell()
+            f.write(b)
+            f.flush()
+            os.fsync(f.fileno())
+        # index is written after data, an interrupted write leaves unindexed data which is ignored
+        line = f'{key}\t{offset}\t{len(b)}\n'.encode('utf8')
+        with open(self.index_path, 'a+b') as f:
+            # start a new line after a line broken by an interrupted write, otherwise both are dropped
+            if f.seek(0, os.SEEK_END) > 0:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    line = b'\n' + line
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.index[key] = (offset, len(b))
+
+    def load_many(self, keys) -> List[object]:
+        with open(self.data_path, 'rb') as f:
+            rv = []
+            for key in keys:
+                offset, length = self.index[str(key)]
+                f.seek(offset)
+                rv.append(self.decode(f.read(length)))
+            return rv
+
+    def iter_items(self) -> Iterator[Tuple[str, object]]:
+        """
+        Yields (key, data) in order of keys, reading the data file sequentially when possible.
+        """
+        keys = self.keys()
+        if not keys:
+            return
+        with open(self.data_path, 'rb') as f:
+            for key in keys:
+                offset, length = self.index[key]
+                f.seek(offset)
+                yield key, self.decode(f.read(length))
+
+    def remove_stale_data_files(self, data_path):
+        """
+        Remove data files of other generations, e.g. the one replaced by compact
+        """
+        prefix, suffix = f'{self.name}.', '.jsonl.gz'
+        for file_name in os.listdir(self.dir_path):
+            if not (file_name.startswith(prefix) and file_name.endswith(suffix)):
+                continue
+            middle = file_name[len(prefix):-len(suffix)]
+            path = os.path.join(self.dir_path, file_name)
+            if (not middle or middle.isdigit()) and path != data_path:
+                lg.debug(f'remove stale data file {path}')
+                os.remove(path)
+
+    def compact(self):
+        """
+        Rewrite the collection without stale documents, returns the number of bytes saved.
+        """
+        if not self.index:
+            return 0
+        old_data_path = self.data_path
+        old_size = os.path.getsize(old_data_path)
+        # a data file of the next generation, left by an interrupted compact, is not referred by the index
+        new_data_path = self.get_data_path(self._generation + 1)
+        tmp_index_path = os.path.join(self.dir_path, f'.{self.name}.idx.tmp')
+        with open(old_data_path, 'rb') as f, \
+                open(new_data_path, 'wb') as data_f, open(tmp_index_path, 'w') as index_f:
+            index_f.write(f'#data\t{os.path.basename(new_data_path)}\n')
+            for key in self.keys():
+                offset, length = self.index[key]
+                f.seek(offset)
+                b = f.read(length)
+                index_f.write(f'{key}\t{data_f.tell()}\t{length}\n')
+                data_f.write(b)
+            for _f in (data_f, index_f):
+                _f.flush()
+                os.fsync(_f.fileno())
+        # the only switch, before it the old index and data are intact, after it the new ones are complete
+        os.replace(tmp_index_path, self.index_path)
+        fsync_dir(self.dir_path)
+        self.remove_stale_data_files(new_data_path)
+        self._index = None
+        return old_size - os.path.getsize(new_data_path)
+
+
+def fsync_dir(dir_path):
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
@@ -0,0 +1,100 @@
+import re
+import time
+import threading
+
+
+REGEX_SIZE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$', re.I)
+
+SIZE_UNITS = ['', 'K', 'M', 'G', 'T']
+
+
+def parse_size(s) -> int:
+    """
+    parse size string like 1024, 500K, 1.5M, 2GB into bytes
+    """
+    if isinstance(s, int):
+        return s
+    rv = REGEX_SIZE.match(s)
+    if not rv:
+        raise ValueError(f'invalid size: {s}')
+    number, unit = rv.groups()
+    return int(float(number) * 1024 ** SIZE_UNITS.index(unit.upper()))
+
+
+def format_size(n) -> str:
+    for unit in SIZE_UNITS:
+        if abs(n) < 1024 or unit == SIZE_UNITS[-1]:
+            break
+        n /= 1024
+    if unit:
+        return f'{n:.1f}{unit}B'
+    return f'{n}B'
+
+
+def format_duration(seconds) -> str:
+    seconds = int(seconds)
+    h, m, s = seconds // 3600, seconds // 60 % 60, seconds % 60
+    return f'{h}:{m:02d}:{s:02d}'
+
+
+class Throttle:
+    """
+    Limit the average throughput to rate bytes per second, by sleeping in consume.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.start_time = time.monotonic()
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            self.total += n
+            wait = self.total / self.rate - (time.monotonic() - self.start_time)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """
+    Limit requests to rate per second, shared by threads, by sleeping in acquire until the next slot.
+    0 means no limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ByteBudget:
+    """
+    Max bytes allowed to be downloaded in a run, 0 means no limit.
+    """
+
+    def __init__(self, max_bytes=0):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self.exhausted = False
+
+    def allows(self, size):
+        if not self.max_bytes:
+            return True
+        if self.used + size > self.max_bytes:
+            self.exhausted = True
+            return False
+        return True
+
+    def add(self, size):
+        self.used += size
@@ -0,0 +1,89 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from typing import Optional
+from urllib.parse import urlparse
+import requests
+
+
+lg = logging.getLogger('xiami.cache')
+
+
+# uri -> ttl in seconds, responses of uris not listed here are never cached
+DEFAULT_TTLS = {
+    '/api/favorite/getFavorites': 3600,
+    '/api/collect/getCollectByUser': 3600,
+    '/api/collect/getCollectStaticUrl': 24 * 3600,
+    '/api/album/getAlbumDetailNormal': 7 * 24 * 3600,
+    # listenFile urls in play info expire in a day (expire=86400)
+    '/api/song/getPlayInfo': 3600,
+}
+
+# params that change on every request and should not be part of the key
+IGNORED_PARAMS = ['_s']
+
+
+class ResponseCache:
+    """
+    On-disk cache for http responses, each response is stored as a json file
+    named by the hash of method + path + params (excluding signature ``_s``).
+    """
+
+    def __init__(self, dir_path, ttls=None):
+        self.dir_path = dir_path
+        self.ttls = dict(DEFAULT_TTLS)
+        if ttls:
+            self.ttls.update(ttls)
+
+    def get_ttl(self, url) -> int:
+        return self.ttls.get(urlparse(url).path, 0)
+
+    def make_key(self, method, url, params=None):
+        url_parsed = urlparse(url)
+        items = []
+        if params:
+            items = sorted((k, v) for k, v in params.items() if k not in IGNORED_PARAMS)
+        key_str = json.dumps([method.lower(), url_parsed.netloc, url_parsed.path, items], ensure_ascii=False)
+        return hashlib.sha1(key_str.encode()).hexdigest()
+
+    def get_file_path(self, key):
+        return os.path.join(self.dir_path, key[:2], f'{key}.json')
+
+    def get(self, key, ttl) -> Optional[requests.Response]:
+        file_path = self.get_file_path(key)
+        try:
+            with open(file_path, 'r') as f:
+                d = json.loads(f.read())
+        except (OSError, ValueError):
+            return None
+        if time.time() - d['created_at'] > ttl:
+            lg.debug(f'cache expired: {d["url"]}')
+            return None
+
+        lg.debug(f'cache hit: {d["url"]}')
+        resp = requests.Response()
+        resp.status_code = d['status_code']
+        resp.url = d['url']
+        resp.headers.update(d['headers'])
+        resp.encoding = d['encoding']
+        resp._content = d['content'].encode(d['encoding'] or 'utf8')
+        return resp
+
+    def set(self, key, resp: requests.Response):
+        d = {
+            'url': resp.url,
+            'status_code': resp.status_code,
+            'headers': {k: v for k, v in resp.headers.items() if k.lower() == 'content-type'},
+            'encoding': resp.encoding or 'utf8',
+            'content': resp.text,
+            'created_at': time.time(),
+        }
+        file_path = self.get_file_path(key)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        # write to a temp file then rename, so that a crash never leaves a broken cache file
+        tmp_path = f'{file_path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(json.dumps(d, ensure_ascii=False))
+        os.replace(tmp_path, file_path)
@@ -0,0 +1,147 @@
+import os
+import re
+import hashlib
+import logging
+from pathlib import Path
+from typing import Optional, Iterator
+from .models import db, MusicFile
+
+
+lg = logging.getLogger('xiami.catalog')
+
+
+REGEX_MUSIC_FILE = re.compile(r'^\d+-(\d+)\.')
+
+
+def parse_music_file_name(file_name) -> Optional[int]:
+    """
+    returns song id if file name matches ROW_NUMBER-SONG_ID.ext
+    """
+    if file_name.endswith('.json'):
+        # skip .json files
+        return None
+    rv = REGEX_MUSIC_FILE.search(file_name)
+    if not rv:
+        lg.debug(f'file {file_name}: skip for name not match ROW_NUMBER-SONG_ID.mp3 file pattern')
+        return None
+    return int(rv.groups()[0])
+
+
+def file_hash(file_path, block_size=1024 * 1024):
+    h = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+class MusicCatalog:
+    """
+    Index of music files in music_dir, stored in the music_file table.
+
+    ``refresh`` scans directories with os.scandir and only writes entries whose size or mtime changed,
+    lookups by song id are then served by the database instead of walking the directory.
+    """
+
+    def __init__(self, music_dir):
+        self.music_dir = Path(music_dir)
+
+    def rel_dir(self, dir_path) -> str:
+        if not dir_path:
+            return ''
+        rel = os.path.relpath(dir_path, self.music_dir)
+        if rel == '.':
+            return ''
+        return rel.replace(os.sep, '/')
+
+    def get_path(self, mf: MusicFile) -> Path:
+        return self.music_dir.joinpath(mf.path)
+
+    def scope_where(self, dir_path=None, recurse=False):
+        d = self.rel_dir(dir_path)
+        if recurse:
+            if not d:
+                return True
+            return (MusicFile.dir == d) | MusicFile.dir.startswith(d + '/')
+        return MusicFile.dir == d
+
+    def scan(self, dir_path, recurse) -> Iterator[os.DirEntry]:
+        try:
+            it = os.scandir(dir_path)
+        except FileNotFoundError:
+            return
+        with it:
+            for entry in it:
+                if entry.is_dir():
+                    if recurse:
+                        yield from self.scan(entry.path, recurse)
+                elif entry.is_file() and not entry.name.startswith('.'):
+                    yield entry
+
+    def refresh(self, dir_path=None, recurse=False, compute_hash=False):
+        """
+        Update catalog for files in dir_path, returns counts of added, updated, removed and unchanged entries.
+        """
+        if not dir_path:
+            dir_path = self.music_dir
+        stats = dict(added=0, updated=0, removed=0, unchanged=0)
+
+        existing = {mf.path: mf for mf in MusicFile.select().where(self.scope_where(dir_path, recurse))}
+        seen = set()
+        rows = []
+        for entry in self.scan(dir_path, recurse):
+            song_id = parse_music_file_name(entry.name)
+            if song_id is None:
+                continue
+            d = self.rel_dir(os.path.dirname(entry.path))
+            path = f'{d}/{entry.name}' if d else entry.name
+            seen.add(path)
+            st = entry.stat()
+            mf = existing.get(path)
+            if mf and mf.size == st.st_size and mf.mtime == st.st_mtime_ns:
+                if not compute_hash or mf.hash:
+                    stats['unchanged'] += 1
+                    continue
+            stats['updated' if mf else 'added'] += 1
+            rows.append({
+                'path': path,
+                'dir': d,
+                'file_name': entry.name,
+                'song_id': song_id,
+                'size': st.st_size,
+                'mtime': st.st_mtime_ns,
+                'hash': file_hash(entry.path) if compute_hash else '',
+            })
+
+        removed = [i for i in existing if i not in seen]
+        stats['removed'] = len(removed)
+        with db.atomic():
+            for i in range(0, len(rows), 100):
+                MusicFile.replace_many(rows[i:i + 100]).execute()
+            for i in range(0, len(removed), 500):
+                MusicFile.delete().where(MusicFile.path.in_(removed[i:i + 500])).execute()
+
+        lg.info(f'refresh catalog {dir_path}: {stats}')
+        return stats
+
+    def iter_files(self, dir_path=None, recurse=False) -> Iterator[MusicFile]:
+        q = MusicFile.select().where(self.scope_where(dir_path, recurse)).order_by(MusicFile.path)
+        return iter(q)
+
+    def is_current(self, mf: MusicFile) -> bool:
+        """
+        whether the file of the entry still exists with the same size and mtime, by one stat call
+        """
+        try:
+            st = os.stat(self.get_path(mf))
+        except FileNotFoundError:
+            return False
+        return mf.size == st.st_size and mf.mtime == st.st_mtime_ns
+
+    def find(self, song_id, dir_path=None) -> Optional[MusicFile]:
+        return (MusicFile.select()
+                .where(MusicFile.song_id == song_id, MusicFile.dir == self.rel_dir(dir_path))
+                .first())
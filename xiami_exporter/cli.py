@@ -1,6 +1,5 @@
 from pathlib import Path
 import json
-import shutil
 import os
 import sys
 import time
@@ -9,17 +8,28 @@ import click
 from collections import OrderedDict
 from urllib.parse import urlparse
 from .client import XiamiClient, FavType, trim_song, trim_album
-from .fetch_loader import load_fetch_module
-from .store import FileStore
+from .store import FileStore, COLLECTIONS, SHARED_COLLECTIONS, SharedJsonBackend, get_json_backend
+from .catalog import MusicCatalog
+from .journal import Journal
+from .ingest import ingest_fav_songs, ingest_song_list, get_songs_by_ids
+from .download_queue import DownloadQueue
+from .collect import MODES as COLLECT_MODES
+from .playlist import FORMATS as PLAYLIST_FORMATS
+from .workqueue import WorkQueue
+from .retry import RetryPolicy, RetryScheduler, is_transient_error, is_local_error
+from .quality import QualityPolicy, DEFAULT_POLICY
+from .bandwidth import Throttle, RateLimiter, ByteBudget, parse_size, format_size, format_duration
+from .metrics import MetricsWriter, Progress
+from .profiling import Profiler
+from . import metrics
 from .http_util import save_response_to_file
-from .os_util import ensure_dir, dir_files_sorted
+from .os_util import ensure_dir
 from .config import cfg
 from .models import (
     db, create_song, Song,
     SongList, SongListType, SONG_LIST_TYPES,
-    DownloadStatus, DoesNotExist,
+    DownloadStatus, JobState, MusicFile,
 )
-from .id3 import Tagger
 
 
 lg = logging.getLogger('cli')
@@ -31,9 +41,11 @@ DEFAULT_UA = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_6) AppleWebKit/537.36
 
 
 def check_fetch():
-    file_path = 'fetch.py'
+    from .fetch_loader import load_fetch_module
+
+    file_path = cfg.fetch_file
     if not os.path.exists(file_path):
-        click.echo('fetch.py not found, please create the file by pasting "Copy as Node.js fetch" from Chrome.')
+        click.echo(f'{file_path} not found, please create the file by pasting "Copy as Node.js fetch" from Chrome.')
         click.echo('For more detailed instructions, please read https://github.com/reorx/xiami_exporter')
         sys.exit(1)
 
@@ -45,8 +57,18 @@ def get_client():
     # change headers
     if 'User-Agent' not in headers and 'user-agent' not in headers:
         headers['User-Agent'] = DEFAULT_UA
-    client = XiamiClient(session, headers=headers, proxy_url=cfg.proxy_url, wait_time=cfg.wait_time)
+    cache = None
+    if cfg.http_cache:
+        from .cache import ResponseCache
+        lg.info(f'use http cache: {cfg.http_cache_dir}')
+        cache = ResponseCache(cfg.http_cache_dir, cfg.http_cache_ttls)
+    client = XiamiClient(
+        session, base_url=cfg.base_url or None, headers=headers,
+        proxy_url=cfg.proxy_url, wait_time=cfg.wait_time, cache=cache)
     client.set_user_id(cfg.user_id)
+    # re-read fetch.py if the token could not be refreshed from Set-Cookie,
+    # so that fetch.py can be updated without restarting a long run
+    client.token_loader = lambda: check_fetch()[0]
     return client
 
 
@@ -60,11 +82,39 @@ def prepare_db():
 
 @click.group()
 @click.option('-d', '--debug', is_flag=True)
-def cli(debug):
+@click.option('--http-cache', is_flag=True, help='cache api responses on disk, useful for re-running and debugging')
+@click.option('--progress', is_flag=True, help='show a live progress bar, info logs are hidden')
+@click.option('--metrics-file', default='', help='write metrics to this file periodically')
+@click.option('--metrics-format', default='prom', type=click.Choice(['prom', 'jsonl']),
+              help='prom: prometheus text format, replaced each time; jsonl: append a json line each time')
+@click.option('--metrics-interval', default=10, help='seconds between metrics file writes')
+@click.option('--profile', default='', help='profile the command with cProfile, dump stats to this file and print a summary')
+@click.option('--json-workers', default=0, help='processes to load exported json in parallel, 0 means one process')
+@click.option('--account', '-a', default='', help='account defined in "accounts" of config.json, audio files, covers and album details are shared by accounts')
+@click.pass_context
+def cli(ctx, debug, http_cache, progress, metrics_file, metrics_format, metrics_interval, profile, json_workers, account):
+    if account:
+        cfg.override(account=account)
+    if http_cache:
+        cfg.override(http_cache=True)
+    if json_workers:
+        cfg.override(json_workers=json_workers)
+    if progress:
+        cfg.override(progress=True)
+        if not debug:
+            logging.getLogger().setLevel(logging.WARNING)
     if debug:
         lg.setLevel(logging.DEBUG)
         # uncomment this line to see peewee db log
         # logging.getLogger().setLevel(logging.DEBUG)
+    if metrics_file:
+        writer = MetricsWriter(metrics_file, metrics_format, metrics_interval)
+        writer.start()
+        ctx.call_on_close(writer.stop)
+    if profile:
+        profiler = Profiler(profile)
+        profiler.start()
+        ctx.call_on_close(profiler.stop)
 
 
 @cli.command()
@@ -85,15 +135,31 @@ def check():
     click.echo('Success, you can now use the export commands')
 
 
-def get_fav_type_dir(fav_type):
-    name = {
-        FavType.SONGS: 'json_songs_dir',
-        FavType.ALBUMS: 'json_albums_dir',
-        FavType.ARTISTS: 'json_artists_dir',
-        FavType.PLAYLISTS: 'json_playlists_dir',
-        FavType.MY_PLAYLISTS: 'json_my_playlists_dir',
-    }[fav_type]
-    return getattr(cfg, name)
+# json backend -> instance, so that the archive index is read once in a command
+_json_docs_cache = {}
+
+
+def get_json_docs():
+    docs = _json_docs_cache.get(cfg.json_backend)
+    if docs is None:
+        docs = _json_docs_cache[cfg.json_backend] = get_json_backend(cfg)
+    return docs
+
+
+def get_fav_type_collection(fav_type):
+    """
+    collection of the pages, e.g. songs, my_playlists
+    """
+    return fav_type.name.lower()
+
+
+DETAIL_FAV_TYPES = [FavType.ALBUMS, FavType.PLAYLISTS, FavType.MY_PLAYLISTS]
+
+# song list type of details that are ingested, same as create-song-list-db, fav playlists are not ingested
+INGEST_SONG_LIST_TYPES = {
+    FavType.ALBUMS: SongListType.ALBUM,
+    FavType.MY_PLAYLISTS: SongListType.PLAYLIST,
+}
 
 
 @cli.command(help='export fav data as json files')
@@ -101,73 +167,211 @@ def get_fav_type_dir(fav_type):
 @click.option('--page', '-p', default='', help='page number, if omitted, all pages will be exported')
 @click.option('--page-size', '-s', default=100, help='page size, default is 100, max is 100')
 @click.option('--complete-songs', '-c', is_flag=True, help='complete songs db for ALBUMS, PLAYLISTS, MY_PLAYLISTS')
-def export(fav_type, page, page_size, complete_songs):
+@click.option('--resume', '-r', is_flag=True, help='skip pages exported by last run, details are always resumed')
+@click.option('--ingest', '-i', is_flag=True, help='upsert songs and song lists into database as pages arrive')
+def export(fav_type, page, page_size, complete_songs, resume, ingest):
     fav_type = FavType[fav_type]
     cfg.load()
+    # progress is journaled in database
+    prepare_db()
 
     if complete_songs:
-        if fav_type not in [FavType.ALBUMS, FavType.PLAYLISTS, FavType.MY_PLAYLISTS]:
+        if fav_type not in DETAIL_FAV_TYPES:
             print(f'--complete-songs is not supported for {fav_type.name}')
             sys.exit(1)
-        export_detail_by_fav_type(fav_type)
+        export_detail_by_fav_type(fav_type, ingest=ingest)
     else:
-        export_by_fav_type(fav_type, page, page_size)
+        export_by_fav_type(fav_type, page, page_size, resume, ingest=ingest)
 
 
-def export_detail_by_fav_type(fav_type: FavType):
-    client = get_client()
+# export-all task priorities, pages are fetched before details,
+# so that the lists are complete as early as possible
+PRIORITY_SONGS_PAGE = 0
+PRIORITY_LIST_PAGE = 1
+PRIORITY_DETAIL = 2
 
-    dir_dict = {
-        FavType.ALBUMS: cfg.json_albums_details_dir,
-        FavType.PLAYLISTS: cfg.json_playlists_details_dir,
-        FavType.MY_PLAYLISTS: cfg.json_my_playlists_details_dir,
-    }
-    dir_path = dir_dict[fav_type]
-    ensure_dir(dir_path)
 
-    fav_dir_path = get_fav_type_dir(fav_type)
-    for file_name in dir_files_sorted(fav_dir_path):
-        lg.info(f'* scanning {file_name}')
-        with open(fav_dir_path.joinpath(file_name), 'r') as f:
-            items = json.loads(f.read())
+@cli.command(help='export all fav types and their details with one client, songs and song lists are created in database as they arrive')
+@click.option('--page-size', '-s', default=100, help='page size, default is 100, max is 100')
+@click.option('--resume', '-r', is_flag=True, help='skip pages exported by last run, details are always resumed')
+@click.option('--skip-db', is_flag=True, help='do not create songs and song lists in database')
+def export_all(page_size, resume, skip_db):
+    cfg.load()
+    prepare_db()
+    # one client for all requests, requests are rate limited by wait_time of the client
+    client = get_client()
 
-        for item in items:
-            if fav_type in [FavType.PLAYLISTS, FavType.MY_PLAYLISTS]:
-                item_id = item['listId']
-            else:  # fav_type == FavType.ALBUMS:
-                item_id = item['albumId']
-            file_name = f'{item_id}.json'
-            file_path = dir_path.joinpath(file_name)
-            if file_path.exists():
-                print(f'skip existing: {file_path}')
+    queue = WorkQueue()
+    page_journals = {}
+    detail_journals = {}
+    for fav_type in FavType:
+        journal = page_journals[fav_type] = Journal(f'export:{fav_type.name}')
+        if not resume:
+            journal.reset()
+        priority = PRIORITY_SONGS_PAGE if fav_type == FavType.SONGS else PRIORITY_LIST_PAGE
+        queue.push(priority, ('page', fav_type, 1))
+    for fav_type in DETAIL_FAV_TYPES:
+        journal = detail_journals[fav_type] = Journal(f'export_detail:{fav_type.name}')
+        journal.recover()
+
+    while queue:
+        metrics.queue_depth.set(len(queue))
+        kind, fav_type, arg = queue.pop()
+        if kind == 'page':
+            page = arg
+            items = export_page(client, page_journals[fav_type], fav_type, page, page_size, resume)
+            if not items:
                 continue
+            if not skip_db:
+                ingest_page(fav_type, page, page_size, items)
+            priority = PRIORITY_SONGS_PAGE if fav_type == FavType.SONGS else PRIORITY_LIST_PAGE
+            queue.push(priority, ('page', fav_type, page + 1))
+            if fav_type in DETAIL_FAV_TYPES:
+                for item in items:
+                    queue.push(PRIORITY_DETAIL, ('detail', fav_type, item))
+        else:
+            data = export_detail(client, detail_journals[fav_type], fav_type, arg, load_exported=not skip_db)
+            if data and not skip_db:
+                ingest_detail(fav_type, data)
+    metrics.queue_depth.set(0)
 
-            if fav_type in [FavType.PLAYLISTS, FavType.MY_PLAYLISTS]:
-                if item['type'] != 0:
-                    # skip system created playlists
-                    continue
-                data = client.get_playlist_detail(item_id)
-            else:  # fav_type == FavType.ALBUMS:
-                data = client.get_album_detail(item_id)
-                trim_album(data)
 
-            for song in data['songs']:
-                trim_song(song)
+def ingest_page(fav_type: FavType, page, page_size, items):
+    if fav_type == FavType.SONGS:
+        # row numbers are the same as create-songs-db, if all pages have the same size
+        ingest_fav_songs(items, (page - 1) * page_size + 1)
 
-            print(f'write json: {file_path}')
-            with open(file_path, 'w') as f:
-                json.dump(data, f, ensure_ascii=False)
 
+def ingest_detail(fav_type: FavType, data):
+    list_type = INGEST_SONG_LIST_TYPES.get(fav_type)
+    if list_type:
+        ingest_song_list(list_type, get_item_id(fav_type, data), data['songs'])
+
+
+def get_detail_collection(fav_type):
+    """
+    collection of the details, e.g. albums/details
+    """
+    return f'{get_fav_type_collection(fav_type)}/details'
+
+
+def get_item_id(fav_type, item):
+    if fav_type in [FavType.PLAYLISTS, FavType.MY_PLAYLISTS]:
+        return item['listId']
+    else:  # fav_type == FavType.ALBUMS:
+        return item['albumId']
 
-def export_by_fav_type(fav_type: FavType, page, page_size):
-    client = get_client()
+
+def export_detail_by_fav_type(fav_type: FavType, client=None, ingest=False):
+    client = client or get_client()
+    journal = Journal(f'export_detail:{fav_type.name}')
+    journal.recover()
+
+    for key, items in get_json_docs().iter_items(get_fav_type_collection(fav_type)):
+        lg.info(f'* scanning {key}')
+        for item in items:
+            data = export_detail(client, journal, fav_type, item, load_exported=ingest)
+            if data and ingest:
+                ingest_detail(fav_type, data)
+
+
+def export_detail(client, journal: Journal, fav_type: FavType, item, load_exported=False):
+    """
+    Export detail of an album or playlist item to json, returns the detail,
+    or None if it's skipped.
+
+    If load_exported is True, the detail exported before is loaded and returned.
+    """
+    docs = get_json_docs()
+    collection = get_detail_collection(fav_type)
+    item_id = get_item_id(fav_type, item)
+    if is_detail_exported(journal, collection, item_id):
+        print(f'skip existing: {collection}/{item_id}')
+        if load_exported:
+            return docs.load(collection, item_id)
+        return None
+
+    if fav_type in [FavType.PLAYLISTS, FavType.MY_PLAYLISTS]:
+        if item['type'] != 0:
+            # skip system created playlists
+            return None
+
+    journal.start(item_id)
+    try:
+        if fav_type in [FavType.PLAYLISTS, FavType.MY_PLAYLISTS]:
+            data = client.get_playlist_detail(item_id)
+        else:  # fav_type == FavType.ALBUMS:
+            data = client.get_album_detail(item_id)
+            trim_album(data)
+
+        for song in data['songs']:
+            trim_song(song)
+
+        print(f'write json: {collection}/{item_id}')
+        docs.save(collection, item_id, data)
+    except Exception as e:
+        journal.fail(item_id, repr(e))
+        raise
+    journal.done(item_id)
+    return data
+
+
+def is_detail_exported(journal: Journal, collection, item_id):
+    docs = get_json_docs()
+    state = journal.get_state(item_id)
+    if state is not None:
+        return state == JobState.DONE and docs.has(collection, item_id)
+    if not docs.has(collection, item_id):
+        return False
+
+    # file written by versions without journal may be broken, check it once
+    try:
+        docs.load(collection, item_id)
+    except ValueError:
+        lg.warning(f'broken json, export again: {collection}/{item_id}')
+        return False
+    journal.done(item_id)
+    return True
+
+
+def export_by_fav_type(fav_type: FavType, page, page_size, resume=False, client=None, ingest=False):
+    client = client or get_client()
+    journal = Journal(f'export:{fav_type.name}')
+    if not resume:
+        journal.reset()
 
     if page:
         get_once = True
+        page = int(page)
     else:
         get_once = False
         page = 1
 
+    while True:
+        items = export_page(client, journal, fav_type, page, page_size, resume)
+        if items and ingest:
+            ingest_page(fav_type, page, page_size, items)
+        if not items or get_once:
+            break
+        page += 1
+        time.sleep(1)
+
+
+def export_page(client, journal: Journal, fav_type: FavType, page, page_size, resume=False):
+    """
+    Export a page of fav_type to json, returns the items, an empty list means the last page is passed.
+
+    If resume is True and the page was exported, the items are loaded from json.
+    """
+    docs = get_json_docs()
+    collection = get_fav_type_collection(fav_type)
+    key = f'{fav_type.name.lower()}-{page}'
+    # the journal key includes page_size, pages of different sizes are different
+    page_key = f'{page}/{page_size}'
+    if resume and journal.is_done(page_key) and docs.has(collection, key):
+        print(f'skip exported page: {collection}/{key}')
+        return docs.load(collection, key)
+
     method_dict = {
         FavType.SONGS: client.get_fav_songs,
         FavType.ALBUMS: client.get_fav_albums,
@@ -180,28 +384,27 @@ def export_by_fav_type(fav_type: FavType, page, page_size):
         FavType.SONGS: trim_song,
     }
 
-    dir_path = get_fav_type_dir(fav_type)
-    ensure_dir(dir_path)
-    while True:
-        client_method = method_dict[fav_type]
+    journal.start(page_key)
+    client_method = method_dict[fav_type]
+    try:
         items = client_method(page, page_size)
-        if not items:
-            break
-        lg.debug(f'{client_method.__name__} results length {len(items)}')
-
-        for item in items:
-            if fav_type in trim_dict:
-                trim_dict[fav_type](item)
+    except Exception as e:
+        journal.fail(page_key, repr(e))
+        raise
+    if not items:
+        journal.done(page_key)
+        return []
+    lg.debug(f'{client_method.__name__} results length {len(items)}')
 
-        file_path = dir_path.joinpath(f'{fav_type.name.lower()}-{page}.json')
-        print(f'write json: {file_path}')
-        with open(file_path, 'w') as f:
-            json.dump(items, f, ensure_ascii=False)
+    for item in items:
+        if fav_type in trim_dict:
+            trim_dict[fav_type](item)
+    metrics.export_items.inc(len(items), fav_type=fav_type.name)
 
-        if get_once:
-            break
-        page += 1
-        time.sleep(1)
+    print(f'write json: {collection}/{key}')
+    docs.save(collection, key, items)
+    journal.done(page_key)
+    return items
 
 
 @cli.command(help='create songs in database')
@@ -235,112 +438,55 @@ def create_song_list_db(songlist_type, clear):
         SongList.delete().execute()
 
     # albums
+    docs = get_json_docs()
     if songlist_type == SongListType.ALBUM:
-        details_dir = cfg.json_albums_details_dir
-        for file_name in dir_files_sorted(details_dir):
-            with open(details_dir.joinpath(file_name), 'r') as f:
-                detail = json.loads(f.read())
-
-            album_id = detail['albumId']
-            attrs = {'in_albums': True}
-            lg.debug(f'album detail: album_id={album_id} songs={len(detail["songs"])}')
-            with db.atomic():
-                for song_data in detail['songs']:
-                    song_id = song_data["songId"]
-                    try:
-                        song = Song.get(Song.id == song_id)
-                    except DoesNotExist:
-                        song = None
-                    if song:
-                        song.in_albums = True
-                        song.save()
-                    else:
-                        try:
-                            create_song(song_data, 0, attrs)
-                        except Exception:
-                            print(f'create_song error: album_id={album_id} song_id={song_id}')
-                            raise
-                    try:
-                        SongList.get(
-                            SongList.list_type == SongListType.ALBUM,
-                            SongList.list_id == album_id,
-                            SongList.song_id == song_id)
-                    except SongList.DoesNotExist:
-                        sl = SongList(
-                            list_type=SongListType.ALBUM,
-                            list_id=album_id,
-                            song_id=song_id,
-                        )
-                        sl.save(force_insert=True)
+        for _, detail in docs.iter_items(get_detail_collection(FavType.ALBUMS)):
+            lg.debug(f'album detail: album_id={detail["albumId"]} songs={len(detail["songs"])}')
+            ingest_song_list(SongListType.ALBUM, detail['albumId'], detail['songs'])
     else:
         # playlists
         def yield_playlist_details():
-            # for file_name in dir_files_sorted(cfg.json_playlists_details_dir):
-            #     yield file_name, cfg.json_playlists_details_dir.joinpath(file_name)
-            for file_name in dir_files_sorted(cfg.json_my_playlists_details_dir):
-                yield file_name, cfg.json_my_playlists_details_dir.joinpath(file_name)
-
-        for file_name, file_path in yield_playlist_details():
-            with open(file_path, 'r') as f:
-                detail = json.loads(f.read())
-
-            playlist_id = detail['listId']
-            attrs = {'in_playlists': True}
-            lg.debug(f'playlist detail: playlist_id={playlist_id} songs={len(detail["songs"])}')
-            with db.atomic():
-                for song_data in detail['songs']:
-                    song_id = song_data["songId"]
-                    try:
-                        song = Song.get(Song.id == song_id)
-                    except DoesNotExist:
-                        song = None
-                    if song:
-                        song.in_playlists = True
-                        song.save()
-                    else:
-                        try:
-                            create_song(song_data, 0, attrs)
-                        except Exception:
-                            print(f'create_song error: playlist_id={playlist_id} song_id={song_id}')
-                            raise
-                    try:
-                        SongList.get(
-                            SongList.list_type == SongListType.PLAYLIST,
-                            SongList.list_id == playlist_id,
-                            SongList.song_id == song_id)
-                    except SongList.DoesNotExist:
-                        sl = SongList(
-                            list_type=SongListType.PLAYLIST,
-                            list_id=playlist_id,
-                            song_id=song_id,
-                        )
-                        sl.save(force_insert=True)
-
-
-def get_effective_playinfo(song_id, playinfos):
-    playinfo = sorted(playinfos, key=lambda x: x['fileSize'], reverse=True)[0]
-    if playinfo['fileSize'] == 0:
+            # yield from docs.iter_items(get_detail_collection(FavType.PLAYLISTS))
+            yield from docs.iter_items(get_detail_collection(FavType.MY_PLAYLISTS))
+
+        for _, detail in yield_playlist_details():
+            lg.debug(f'playlist detail: playlist_id={detail["listId"]} songs={len(detail["songs"])}')
+            ingest_song_list(SongListType.PLAYLIST, detail['listId'], detail['songs'])
+
+
+def get_effective_playinfo(song_id, playinfos, policy: QualityPolicy = DEFAULT_POLICY):
+    playinfo = policy.select(playinfos)
+    if not playinfo:
         lg.debug(f'no valid file in playinfo: id={song_id}')
         return
     return playinfo
 
 
-def get_audioinfos(client, song_ids, try_bak_id=True):
-    urls_dict = {}
+def get_quality_policy():
+    return QualityPolicy(
+        formats=cfg.audio_formats, max_bitrate=cfg.max_bitrate, max_file_size=cfg.max_file_size)
+
+
+def get_audioinfos(client, song_ids, try_bak_id=True, policy: QualityPolicy = DEFAULT_POLICY):
+    playinfos_dict = {}
     for item in client.get_play_info(song_ids):
         # get effective playinfo
         song_id = item["songId"]
         lg.debug(f'get_play_info: {item}')
-        playinfo = get_effective_playinfo(song_id, item['playInfos'])
+        playinfo = get_effective_playinfo(song_id, item['playInfos'], policy)
         if playinfo:
-            urls_dict[song_id] = playinfo['listenFile']
+            playinfos_dict[song_id] = playinfo
 
     audioinfos = []
     for song_id in song_ids:
-        url = urls_dict.get(song_id)
+        playinfo = playinfos_dict.get(song_id, {})
+        url = playinfo.get('listenFile')
         info = {
             'song_id': song_id,
             'url': url,
+            'file_size': playinfo.get('fileSize', 0),
+            'quality': playinfo.get('quality', ''),
+            'format': playinfo.get('format', ''),
         }
         audioinfos.append(info)
         if not url:
@@ -351,18 +497,39 @@ def get_audioinfos(client, song_ids, try_bak_id=True):
                 continue
             lg.info(f'try bak_song_id {song.bak_song_id} for {song.id}')
             for item in client.get_play_info([song.bak_song_id]):
-                playinfo = get_effective_playinfo(item['songId'], item['playInfos'])
+                playinfo = get_effective_playinfo(item['songId'], item['playInfos'], policy)
                 if playinfo:
                     info['url'] = playinfo['listenFile']
+                    info['file_size'] = playinfo['fileSize']
+                    info['quality'] = playinfo['quality']
+                    info['format'] = playinfo['format']
 
     return audioinfos
 
 
-def download_songs(client, audioinfos, update_db=True):
-    for info in audioinfos:
+def download_songs(client, audioinfos, update_db=True, retry_policy: RetryPolicy = None,
+                   budget: ByteBudget = None, throttle: Throttle = None, progress: Progress = None,
+                   queue: DownloadQueue = None):
+    """
+    Returns a list of (song_id, delay) for songs failed by transient errors,
+    which should be retried after delay seconds.
+
+    Stops when the budget is exhausted, check budget.exhausted after calling.
+    queue: the songs are claimed from it, their leases are renewed as songs are downloaded
+    """
+    journal = Journal('download')
+    retries = []
+    for i, info in enumerate(audioinfos):
+        if queue and i > 0:
+            queue.renew([_info['song_id'] for _info in audioinfos[i:]])
         song_id = info['song_id']
+        if budget and not budget.allows(info.get('file_size') or 0):
+            lg.info(f'stop downloading, budget exhausted: {format_size(budget.used)} / {format_size(budget.max_bytes)}')
+            break
+        journal.start(song_id)
+        error = ''
         if update_db:
-            song = Song.get(Song.id == song_id)
+            song = Song.select(Song.id, Song.row_number).where(Song.id == song_id).namedtuples().get()
             prefix = f'{song.row_number}-'
         else:
             song = None
@@ -375,23 +542,74 @@ def download_songs(client, audioinfos, update_db=True):
             ext = Path(_file_name).suffix
             file_name = f'{prefix}{song.id}{ext}'
 
-            resp = client.session.get(url)
-
             file_path = cfg.music_dir.joinpath(file_name)
+            start_time = time.time()
             try:
-                save_response_to_file(resp, file_path=file_path, logger=lg)
+                resp = client.session.get(url, stream=True)
+                resp.raise_for_status()
+                size = save_response_to_file(resp, file_path=file_path, logger=lg, stream=True, throttle=throttle)
+                metrics.download_bytes.inc(size)
+                metrics.download_seconds.observe(time.time() - start_time)
+                if budget:
+                    budget.add(size)
             except Exception as e:
-                download_status = DownloadStatus.FAILED
+                if is_local_error(e):
+                    raise
+                if is_transient_error(e):
+                    download_status = DownloadStatus.FAILED
+                else:
+                    download_status = DownloadStatus.UNAVAILABLE
+                error = repr(e)
                 lg.error(f'failed to download {file_name}:\n  url={url}\n  error={e}')
             else:
                 download_status = DownloadStatus.SUCCESS
         else:
             download_status = DownloadStatus.UNAVAILABLE
+            error = 'no available play info'
 
         lg.info(f'download status of {song_id}: {DownloadStatus.to_str(download_status)}')
+        metrics.download_songs.inc(status=DownloadStatus.to_str(download_status))
+        if progress:
+            progress.update()
         if song:
-            song.download_status = download_status
-            song.save()
+            # only the changed columns are written, the song is done so its lease of the download queue is cleared
+            values = {'download_status': download_status, 'claimed_until': None}
+            if download_status == DownloadStatus.SUCCESS:
+                values.update(
+                    file_size=info.get('file_size') or 0,
+                    quality=info.get('quality') or '',
+                    audio_format=info.get('format') or '',
+                )
+            Song.update(**values).where(Song.id == song.id).execute()
+        if download_status == DownloadStatus.SUCCESS:
+            journal.done(song_id)
+        elif download_status == DownloadStatus.FAILED and retry_policy:
+            delay = retry_policy.get_delay(journal.get(song_id).attempts)
+            journal.fail(song_id, error, retry_delay=delay)
+            if delay is not None:
+                retries.append((song_id, delay))
+        else:
+            # unavailable songs are not retried automatically
+            journal.fail(song_id, error)
+    return retries
+
+
+def skip_stored_songs(catalog: MusicCatalog, journal: Journal, song_ids):
+    """
+    Mark songs whose files are already in music dir as downloaded, e.g. downloaded by another account sharing the dir,
+    returns ids of the other songs.
+    """
+    rv = []
+    for song_id in song_ids:
+        mf = catalog.find(song_id)
+        if not mf:
+            rv.append(song_id)
+            continue
+        lg.info(f'song {song_id} is stored in {mf.path}, skip downloading')
+        Song.update(download_status=DownloadStatus.SUCCESS, file_size=mf.size).where(Song.id == song_id).execute()
+        journal.done(song_id)
+        metrics.download_songs.inc(status='STORED')
+    return rv
 
 
 @cli.command(help='download songs mp3')
@@ -400,115 +618,221 @@ def download_songs(client, audioinfos, update_db=True):
 @click.option('--filter-status', default=DownloadStatus.NOT_SET, help='filter Song.download_status')
 @click.option('--batch-size', default=10, help='number of songs in a batch download task')
 @click.option('--batch-count', default=0, help='number of batch download tasks')
-def download_music(song_list, song_id, filter_status, batch_size, batch_count):
+@click.option('--retry/--no-retry', default=True, help='retry songs failed by transient errors with exponential backoff')
+@click.option('--max-attempts', default=5, help='max attempts for a song failed by transient errors')
+@click.option('--formats', default='', help='preferred audio formats in order, comma separated, e.g. mp3,m4a')
+@click.option('--max-bitrate', default=0, help='max bitrate in kbps, 0 means no limit')
+@click.option('--max-file-size', default=0, help='max file size in bytes, 0 means no limit')
+@click.option('--dry-run', is_flag=True, help='resolve play info and report total size of the queue without downloading')
+@click.option('--max-bytes', default='0', help='stop after downloading this size, e.g. 500M, 2G')
+@click.option('--max-rate', default='0', help='max download rate per second, e.g. 500K, 2M')
+@click.option('--lease', default=0, help='seconds a claimed song is reserved for this process, renewed after each song, '
+                                         'defaults to download_lease in config')
+def download_music(song_list, song_id, filter_status, batch_size, batch_count, retry, max_attempts,
+                   formats, max_bitrate, max_file_size, dry_run, max_bytes, max_rate, lease):
+    if formats:
+        cfg.override(audio_formats=formats.split(','))
+    if max_bitrate:
+        cfg.override(max_bitrate=max_bitrate)
+    if max_file_size:
+        cfg.override(max_file_size=max_file_size)
+    if lease:
+        cfg.override(download_lease=lease)
     cfg.load()
     prepare_db()
+    policy = get_quality_policy()
+    lg.info(f'quality policy: {policy}')
     client = get_client()
     ensure_dir(cfg.music_dir)
+    journal = Journal('download')
+    journal.recover()
+    retry_policy = RetryPolicy(max_attempts=max_attempts) if retry else None
+    scheduler = RetryScheduler()
+    budget = ByteBudget(parse_size(max_bytes))
+    max_rate = parse_size(max_rate)
+    throttle = Throttle(max_rate) if max_rate else None
+    catalog = FileStore(cfg).catalog
+    catalog.refresh()
+
+    progress = None
+
+    queue = DownloadQueue(filter_status, fav_only=not song_list, lease=cfg.download_lease)
+
+    def download_batch(song_ids):
+        try:
+            audioinfos = get_audioinfos(client, song_ids, policy=policy)
+            retries = download_songs(
+                client, audioinfos, retry_policy=retry_policy, budget=budget, throttle=throttle, progress=progress,
+                queue=queue)
+        finally:
+            # songs not downloaded, e.g. stopped by budget, could be claimed by other workers
+            queue.release(song_ids)
+        for _song_id, delay in retries:
+            scheduler.schedule(_song_id, delay)
+        if progress:
+            # a retried song is counted again
+            progress.total += len(retries)
+
+    def download_ready_retries():
+        while not budget.exhausted:
+            song_ids = scheduler.pop_ready(batch_size)
+            if not song_ids:
+                break
+            # skip songs being retried by another worker
+            song_ids = queue.claim_ids(song_ids)
+            if not song_ids:
+                continue
+            lg.info(f'retry songs: {song_ids}')
+            download_batch(song_ids)
+
+    if dry_run:
+        if song_id:
+            estimate_downloads(client, [song_id.split(',')], policy, max_rate, try_bak_id=False)
+        else:
+            # page through the queue without claiming songs
+            estimate_downloads(client, queue.batches(batch_size, claim=False), policy, max_rate)
+        return
 
     if song_id:
         song_ids = song_id.split(',')
-        audioinfos = get_audioinfos(client, song_ids, try_bak_id=False)
-        download_songs(client, audioinfos)
+        audioinfos = get_audioinfos(client, song_ids, try_bak_id=False, policy=policy)
+        download_songs(client, audioinfos, retry_policy=retry_policy, budget=budget, throttle=throttle)
     else:
-        def yield_all_songs(size):
-            songs = []
-            for song in Song.select().where(Song.download_status == filter_status).order_by(Song.row_number):
-                songs.append(song)
-                if len(songs) == size:
-                    yield songs
-                    songs = []
-            if songs:
-                yield songs
-
-        def yield_fav_songs(size):
-            songs = []
-            for song in Song.select().where(
-                Song.download_status == filter_status,
-                Song.in_songs == True,
-            ).order_by(Song.row_number):
-                songs.append(song)
-                if len(songs) == size:
-                    yield songs
-                    songs = []
-            if songs:
-                yield songs
-
-        if song_list:
-            yield_func = yield_all_songs
-        else:
-            yield_func = yield_fav_songs
+        # songs failed by transient errors in previous runs and are eligible now
+        if retry and filter_status != DownloadStatus.FAILED:
+            retryable_keys = set(journal.retryable_keys(max_attempts))
+            q = Song.select(Song.id).where(Song.download_status == DownloadStatus.FAILED)
+            if not song_list:
+                q = q.where(Song.in_songs == True)
+            for song in q:
+                if str(song.id) in retryable_keys:
+                    scheduler.schedule(song.id, 0)
+
+        total = queue.count()
+        if batch_count > 0:
+            total = min(total, batch_count * batch_size)
+        progress = Progress(total + len(scheduler), 'download', enabled=cfg.progress)
 
         _batch_count = 0
-        for songs in yield_func(batch_size):
+        # batches are claimed one at a time, so songs are shared with other workers running on the same database
+        batches = queue.batches(batch_size)
+        for claimed_ids in batches:
             _batch_count += 1
             if batch_count > 0 and _batch_count > batch_count:
+                queue.release(claimed_ids)
+                break
+            song_ids = claimed_ids
+            if filter_status == DownloadStatus.NOT_SET:
+                song_ids = skip_stored_songs(catalog, journal, song_ids)
+                progress.total -= len(claimed_ids) - len(song_ids)
+                # downloaded songs are released by download_batch, only the skipped ones are left
+                kept = set(song_ids)
+                queue.release([i for i in claimed_ids if i not in kept])
+            if song_ids:
+                download_batch(song_ids)
+            download_ready_retries()
+            if budget.exhausted:
                 break
-            audioinfos = get_audioinfos(client, [i.id for i in songs])
-            download_songs(client, audioinfos)
+
+        while scheduler and not budget.exhausted:
+            scheduler.wait()
+            download_ready_retries()
+        progress.close()
+
+    if budget.max_bytes:
+        print(f'downloaded {format_size(budget.used)} of budget {format_size(budget.max_bytes)}')
+
+
+def estimate_downloads(client, batches, policy: QualityPolicy, rate=0, try_bak_id=True):
+    """
+    Resolve play info for songs in the queue, store the selected sizes of songs not downloaded yet and report the total.
+    """
+    total_size = 0
+    count = 0
+    unavailable = 0
+    quality_sizes = {}
+    for song_ids in batches:
+        audioinfos = get_audioinfos(client, song_ids, try_bak_id=try_bak_id, policy=policy)
+        with db.atomic():
+            for info in audioinfos:
+                count += 1
+                if not info['url']:
+                    unavailable += 1
+                    continue
+                size = info['file_size']
+                total_size += size
+                key = f'{info["format"]}/{info["quality"]}'
+                quality_sizes[key] = quality_sizes.get(key, 0) + size
+                # sizes of downloaded songs are what verify checks the files against, they are kept
+                Song.update(
+                    file_size=size, quality=info['quality'], audio_format=info['format'],
+                ).where(Song.id == info['song_id'], Song.download_status != DownloadStatus.SUCCESS).execute()
+
+    print(f'songs: {count}, available: {count - unavailable}, unavailable: {unavailable}')
+    print(f'total size: {format_size(total_size)} ({total_size} bytes)')
+    for key, size in sorted(quality_sizes.items()):
+        print(f'  {key}: {format_size(size)}')
+    if rate:
+        print(f'estimated time at {format_size(rate)}/s: {format_duration(total_size / rate)}')
 
 
 @cli.command(help='collect song lists (albums, playlists) audio files to dirs')
-def collect_song_lists():
-    cfg.load()
+@click.option('--mode', '-m', type=click.Choice(COLLECT_MODES), default='hardlink',
+              help='how audio files are placed, falls back to copy if not supported by the file system')
+@click.option('--workers', '-w', default=8, help='threads to create, link and remove files')
+@click.option('--dry-run', is_flag=True, help='only print the changes')
+@click.option('--playlist-format', '-p', multiple=True, type=click.Choice(['dir'] + PLAYLIST_FORMATS), default=['dir'],
+              help='dir: place audio files of my playlists in dirs; m3u8, xspf: write playlist files that refer to '
+                   'audio files in music dir instead, could be given more than once')
+def collect_song_lists(mode, workers, dry_run, playlist_format):
+    from .collect import CollectPlanner, execute
 
-    # load songs
-    files_dict = FileStore(cfg).load_music_files()
-    # print(type(list(files_dict.keys())[0]))
+    cfg.load()
+    prepare_db()
 
+    planner = CollectPlanner(FileStore(cfg).load_music_files())
+    docs = get_json_docs()
     # albums
-    details_dir = cfg.json_albums_details_dir
-    for file_name in dir_files_sorted(details_dir):
-        with open(details_dir.joinpath(file_name), 'r') as f:
-            detail = json.loads(f.read())
-
-        album_id = detail['albumId']
-        album_name = detail['albumName']
-        album_dir_name = f'{album_id}-{album_name}'
-        album_dir_path = cfg.music_albums_dir.joinpath(album_dir_name)
-        print(f'create album dir: {album_dir_name}')
-        ensure_dir(album_dir_path)
-
-        for song_data in detail['songs']:
-            song_id = song_data['songId']
-            if song_id in files_dict:
-                file_name, file_path = files_dict[song_id]
-                if album_dir_path.joinpath(file_name).exists():
-                    lg.debug(f'destination file exists, skip copy: {file_path}')
-                    pass
-                else:
-                    shutil.copy(file_path, album_dir_path)
-            else:
-                lg.debug(f'song file not found: {song_id}')
-                with open(album_dir_path.joinpath(f'{song_id}.json'), 'w') as f:
-                    f.write(json.dumps(song_data, ensure_ascii=False))
-
+    for _, detail in docs.iter_items(get_detail_collection(FavType.ALBUMS)):
+        album_dir_name = f'{detail["albumId"]}-{detail["albumName"]}'
+        planner.add_song_list(cfg.music_albums_dir.joinpath(album_dir_name), detail['songs'])
     # my playlists
-    details_dir = cfg.json_my_playlists_details_dir
-    for file_name in dir_files_sorted(details_dir):
-        with open(details_dir.joinpath(file_name), 'r') as f:
-            detail = json.loads(f.read())
-
-        pl_id = detail['listId']
-        pl_name = detail['collectName']
-        pl_dir_name = f'{pl_id}-{pl_name}'
-        pl_dir_path = cfg.music_my_playlists_dir.joinpath(pl_dir_name)
-        print(f'create playlist dir: {pl_dir_name}')
-        ensure_dir(pl_dir_path)
-
-        for song_data in detail['songs']:
-            song_id = song_data['songId']
-            if song_id in files_dict:
-                file_name, file_path = files_dict[song_id]
-                if pl_dir_path.joinpath(file_name).exists():
-                    lg.debug(f'destination file exists, skip copy: {file_path}')
-                    pass
-                else:
-                    shutil.copy(file_path, pl_dir_path)
-            else:
-                lg.debug(f'song file not found: {song_id}')
-                with open(pl_dir_path.joinpath(f'{song_id}.json'), 'w') as f:
-                    f.write(json.dumps(song_data, ensure_ascii=False))
+    if 'dir' in playlist_format:
+        for _, detail in docs.iter_items(get_detail_collection(FavType.MY_PLAYLISTS)):
+            pl_dir_name = f'{detail["listId"]}-{detail["collectName"]}'
+            planner.add_song_list(cfg.music_my_playlists_dir.joinpath(pl_dir_name), detail['songs'])
+    playlist_files = [i for i in playlist_format if i != 'dir']
+    if playlist_files:
+        write_playlist_files(playlist_files, dry_run)
+
+    actions = planner.diff()
+    total = sum(len(i) for i in planner.tree.values())
+    print(f'{len(planner.tree)} dirs, {total} files, {len(actions)} changes')
+    if dry_run:
+        for action in actions:
+            print(f'{action.op}: {action.path}')
+        return
+    counter = execute(planner, actions, mode, workers)
+    if counter:
+        print(', '.join(f'{k}: {v}' for k, v in sorted(counter.items())))
+
+
+def write_playlist_files(formats, dry_run=False):
+    from .playlist import write_playlists
+
+    # names are in the pages, so that details are not loaded
+    names = {}
+    for _, items in get_json_docs().iter_items(get_fav_type_collection(FavType.MY_PLAYLISTS)):
+        for item in items:
+            names[item['listId']] = item['collectName']
+    written, unchanged = write_playlists(
+        SongListType.PLAYLIST, names, cfg.music_my_playlists_dir, cfg.music_dir, formats, dry_run=dry_run)
+    if dry_run:
+        for file_path in written:
+            print(f'write: {file_path}')
+        print(f'playlist files: {len(written)} to write, {unchanged} unchanged')
+    else:
+        print(f'playlist files: {len(written)} written, {unchanged} unchanged')
 
 
 @cli.command(help='download album covers')
@@ -518,12 +842,12 @@ def download_covers(force, artist_logos):
     cfg.load()
     prepare_db()
     client = get_client()
-    songs_dict = FileStore(cfg).load_all_song_json()
+    songs_dict = FileStore(cfg).load_all_song_json(fields=['albumLogo', 'artistLogo'])
 
     cover_urls_dict = OrderedDict()
     artist_urls_dict = OrderedDict()
 
-    for song in Song.select():
+    for song in Song.select(Song.id, Song.album_id, Song.artist_id).namedtuples():
         data = songs_dict.get(song.id)
         if not data:
             lg.warn(f'could not found song {song.id} in json files')
@@ -578,10 +902,45 @@ def download_covers(force, artist_logos):
             lg.error(f'failed to download {file_name}:\n  url={url}\n  error={e}')
 
 
+@cli.command(help='download lyric files of songs, tag-music embeds them into audio files')
+@click.option('--force', '-f', is_flag=True, help='force download even if lyric file already exists')
+@click.option('--workers', '-w', default=4, help='threads to download lyric files')
+@click.option('--rate', default=4.0, help='max requests per second of all threads, 0 means no limit')
+def download_lyrics(force, workers, rate):
+    from .lyrics import get_lyric_url, find_lyric_files, download_lyrics as _download_lyrics
+
+    cfg.load()
+    prepare_db()
+    client = get_client()
+    client.rate_limiter = RateLimiter(rate)
+    songs_dict = FileStore(cfg).load_all_song_json(fields=['lyricInfo'])
+    existing = {} if force else find_lyric_files(cfg.lyrics_dir)
+
+    items = []
+    no_lyric = 0
+    for row in Song.select(Song.id).namedtuples():
+        data = songs_dict.get(row.id)
+        if not data:
+            lg.warning(f'could not found song {row.id} in json files')
+            continue
+        url = get_lyric_url(data)
+        if not url:
+            no_lyric += 1
+        elif row.id not in existing:
+            items.append((row.id, url))
+    print(f'lyrics to download: {len(items)}, existing: {len(existing)}, songs without lyric: {no_lyric}')
+
+    saved, failed = _download_lyrics(client, items, cfg.lyrics_dir, workers)
+    print(f'lyrics downloaded: {saved}, failed: {failed}')
+
+
 @cli.command(help='tag music ID3 from database')
 @click.option('--sub-dir', '-d', default='', help='sub dir of music dir, if omitted, only files under music dir will be tagged')
 @click.option('--show-tags', '-t', default='', help='show tags from a file, for debug purpose')
 def tag_music(sub_dir, show_tags):
+    from .id3 import Tagger, load_cover, TAG_FIELDS
+    from .lyrics import find_lyric_files, lyric_text
+
     cfg.load()
     prepare_db()
     fs = FileStore(cfg)
@@ -596,22 +955,41 @@ def tag_music(sub_dir, show_tags):
     else:
         it = fs.yield_music_files()
 
-    for file_name, file_path, song_id in it:
-        try:
-            song = Song.get(Song.id == song_id)
-        except DoesNotExist:
+    files = list(it)
+    songs = get_songs_by_ids(list(set(i[2] for i in files)), [getattr(Song, i) for i in TAG_FIELDS])
+    lyric_files = find_lyric_files(cfg.lyrics_dir)
+
+    # group files by album, so that album level data like the cover is read once for all tracks
+    albums = OrderedDict()
+    for file_name, file_path, song_id in files:
+        song = songs.get(song_id)
+        if not song:
             lg.warning(f'file {file_name}, id {song_id}: song does not exist')
             continue
+        albums.setdefault(song.album_id, []).append((file_path, song))
 
-        tagger = Tagger(file_path)
-        tagger.tag_by_model(song, clear_old=True)
-
-        # cover
-        cover_file_path = fs.find_cover_file(song.album_id)
+    for album_id, tracks in albums.items():
+        cover = None
+        cover_file_path = fs.find_cover_file(album_id)
         if cover_file_path:
-            tagger.tag_cover(cover_file_path)
-
-        tagger.save()
+            try:
+                cover = load_cover(cover_file_path)
+            except Exception as e:
+                # e.g. an error page saved as the cover, tracks of the album are tagged without cover
+                lg.warning(f'album {album_id}: failed to load cover {cover_file_path}, error={e!r}')
+        lg.debug(f'tag album {album_id}: {len(tracks)} tracks')
+
+        for file_path, song in tracks:
+            tagger = Tagger(file_path)
+            tagger.tag_by_model(song, clear_old=True)
+            if cover:
+                tagger.tag_cover(cover)
+            if song.id in lyric_files:
+                with open(lyric_files[song.id], 'rb') as f:
+                    text = lyric_text(f.read())
+                if text:
+                    tagger.tag_lyrics(text)
+            tagger.save()
 
 
 @cli.command(help='show song information from json/database')
@@ -624,7 +1002,7 @@ def show_song(song_id, str_id, echo_path, echo_database):
     fs = FileStore(cfg)
     if song_id:
         songs_dict = fs.load_all_song_json()
-        data = songs_dict[song_id]
+        data = songs_dict[int(song_id)]
     elif str_id:
         str_id_dict = {}
         fs.load_all_song_json(str_id_dict)
@@ -635,9 +1013,10 @@ def show_song(song_id, str_id, echo_path, echo_database):
 
     song_id = data['songId']
     if echo_path:
-        for _, file_path, song_id_ in fs.yield_music_files():
-            if song_id_ == song_id:
-                print(file_path)
+        prepare_db()
+        file_path = fs.find_music_file(song_id)
+        if file_path:
+            print(file_path)
     elif echo_database:
         prepare_db()
         song = Song.get(Song.id == song_id)
@@ -647,20 +1026,52 @@ def show_song(song_id, str_id, echo_path, echo_database):
         print(json.dumps(data, indent=1, ensure_ascii=False))
 
 
-@cli.command(help='trim useless data in json files, this operation is idempotent')
-def trim_json():
+@cli.command(help='trim useless data in json files, documents already trimmed are skipped, this operation is idempotent')
+@click.option('--workers', '-w', default=0, help='processes to trim in parallel, 0 means the number of cpus')
+def trim_json(workers):
+    from .trim import TRIM_COLLECTIONS, trim_collection
+
     cfg.load()
-    # song
-    _, _, files = next(os.walk(cfg.json_songs_dir))
-    for file_name in files:
-        file_path = cfg.json_songs_dir.joinpath(file_name)
-        with open(file_path, 'r') as f:
-            data = json.loads(f.read())
-        for song in data:
-            trim_song(song)
-        with open(file_path, 'w') as f:
-            lg.info(f'update file {file_path}')
-            f.write(json.dumps(data, ensure_ascii=False))
+    docs = get_json_docs()
+    workers = workers or os.cpu_count() or 1
+    total_saved = 0
+    for collection in TRIM_COLLECTIONS:
+        count, trimmed, size_before, size_after = trim_collection(docs, collection, workers)
+        if not count:
+            continue
+        total_saved += size_before - size_after
+        print(f'{collection}: {trimmed}/{count} trimmed, '
+              f'{format_size(size_before)} -> {format_size(size_after)}')
+    print(f'saved {format_size(total_saved)}')
+
+
+@cli.command(help='convert exported json between the dir and archive layouts, and use the new layout')
+@click.argument('target', nargs=1, type=click.Choice(['dir', 'archive']))
+def convert_json(target):
+    cfg.load()
+    if target == cfg.json_backend:
+        print(f'json backend is already {target}')
+        return
+    src = get_json_backend(cfg)
+    # the shared json follows the top level json_backend, it is converted only without an account
+    dst = get_json_backend(cfg, target, shared_name=None if cfg.account else target)
+    for collection in COLLECTIONS:
+        _src, _dst = src, dst
+        if isinstance(src, SharedJsonBackend) and collection in SHARED_COLLECTIONS:
+            if cfg.account:
+                print(f'{collection}: skipped, shared by accounts, follows the top level json_backend')
+                continue
+            # documents of all accounts, not only the ones owned by the default account
+            _src, _dst = src.shared_backend, dst.shared_backend
+        count = 0
+        for key, data in _src.iter_items(collection):
+            _dst.save(collection, key, data)
+            count += 1
+        # drop documents replaced by saving again
+        _dst.compact(collection)
+        print(f'{collection}: {count} converted')
+    cfg.save_value('json_backend', target)
+    print(f'json backend is changed to {target}, the old files are kept')
 
 
 @cli.command()
@@ -674,6 +1085,63 @@ def update_download_status():
         song.save()
 
 
+@cli.command(help='verify downloaded music files, bad files are marked as FAILED to be downloaded again')
+@click.option('--workers', '-w', default=0, help='number of worker processes, default is cpu count')
+@click.option('--dry-run', is_flag=True, help='only report bad files, do not update database')
+def verify(workers, dry_run):
+    from concurrent.futures import ProcessPoolExecutor
+    from .verify import verify_file
+
+    cfg.load()
+    prepare_db()
+    fs = FileStore(cfg)
+    files = [(str(file_path), song_id) for _, file_path, song_id in fs.yield_music_files()]
+    expected_sizes = {
+        row.id: row.file_size
+        for row in Song.select(Song.id, Song.file_size).where(Song.file_size > 0).namedtuples()
+    }
+    song_ids_dict = dict(files)
+    journal = Journal('download')
+
+    t0 = time.perf_counter()
+    total_size = 0
+    bad = 0
+    with ProcessPoolExecutor(max_workers=workers or None) as executor:
+        it = executor.map(
+            verify_file,
+            [i[0] for i in files],
+            [expected_sizes.get(i[1], 0) for i in files],
+            chunksize=16)
+        for file_path, size, problem in it:
+            total_size += size
+            if not problem:
+                continue
+            bad += 1
+            song_id = song_ids_dict[file_path]
+            print(f'bad file {file_path}: {problem}')
+            if dry_run:
+                continue
+            Song.update(download_status=DownloadStatus.FAILED).where(Song.id == song_id).execute()
+            # eligible for retry immediately
+            journal.fail(song_id, f'verify: {problem}', retry_delay=0)
+
+    seconds = time.perf_counter() - t0
+    print(f'verified {len(files)} files, {bad} bad, in {seconds:.2f}s, '
+          f'{len(files) / seconds:.1f} files/s, {total_size / 1024 / 1024 / seconds:.1f} MB/s')
+
+
+@cli.command(help='index music files in database, other commands refresh it incrementally')
+@click.option('--hash', '-H', 'compute_hash', is_flag=True, help='compute sha1 of file content')
+@click.option('--rebuild', is_flag=True, help='clear the catalog before indexing')
+def catalog(compute_hash, rebuild):
+    cfg.load()
+    prepare_db()
+    if rebuild:
+        MusicFile.delete().execute()
+    stats = MusicCatalog(cfg.music_dir).refresh(recurse=True, compute_hash=compute_hash)
+    print(f'catalog refreshed: {stats}')
+
+
 @cli.command(help='')
 @click.option('--reset', '-r', is_flag=True)
 def migrate(reset):
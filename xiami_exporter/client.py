@@ -4,8 +4,15 @@ import hashlib
 import json
 from contextlib import contextmanager
 from enum import IntEnum
-import requests
-from .http_util import get_cookie_from_cookiejar
+from typing import TYPE_CHECKING
+from .http_util import get_cookie_from_cookiejar, set_cookie_value
+from . import metrics
+from .profiling import span
+
+
+if TYPE_CHECKING:
+    # requests is slow to import, it's only loaded by fetch_loader when a session is created
+    import requests
 
 
 lg = logging.getLogger('xiami.client')
@@ -23,16 +30,36 @@ class FavType(IntEnum):
 
 DEFAULT_PAGE_SIZE = 30
 
+# response codes which mean the xm_sg_tk cookie should be refreshed,
+# the web client of xiami retries the request on these codes
+TOKEN_ERROR_CODES = [
+    'SG_TOKEN_EMPTY',
+    'SG_TOKEN_EXPIRED',
+    'SG_EMPTY',
+    'SG_INVALID',
+]
+
+TOKEN_COOKIE_NAME = 'xm_sg_tk'
+
+
+class TokenError(Exception):
+    pass
+
 
 class HTTPClient:
     base_url = None
 
-    def __init__(self, session: requests.Session, base_url=None, headers=None, proxy_url=None, wait_time=1):
+    def __init__(self, session: 'requests.Session', base_url=None, headers=None, proxy_url=None, wait_time=1, cache=None):
         if base_url:
             self.base_url = base_url
         self.headers = headers or {}
         self.session = session
         self.wait_time = wait_time
+        # bandwidth.RateLimiter, replaces waiting wait_time after each request,
+        # so that the client could be shared by threads under one rate
+        self.rate_limiter = None
+        # ResponseCache, opt-in
+        self.cache = cache
         self.proxy_url = proxy_url
         if proxy_url:
             self.proxies = {
@@ -64,16 +91,45 @@ class HTTPClient:
                 kwargs['headers'].update({
                     'Content-Type': 'application/json',
                 })
+        endpoint = metrics.endpoint_label(url)
+        cache_key = None
+        if self.cache:
+            cache_ttl = self.cache.get_ttl(url)
+            if cache_ttl:
+                cache_key = self.cache.make_key(method, url, kwargs.get('params'))
+                resp = self.cache.get(cache_key, cache_ttl)
+                if resp is not None:
+                    metrics.http_cache_hits.inc(endpoint=endpoint)
+                    return resp
+
         lg.debug(
             'HTTPClient request, %s, %s, %s, %s',
             method, url, args, kwargs)
-        resp = getattr(self.session, method)(url, *args, **kwargs)
+        if self.rate_limiter:
+            self.rate_limiter.acquire()
+        start_time = time.time()
+        try:
+            with span('http'):
+                resp = getattr(self.session, method)(url, *args, **kwargs)
+        except Exception:
+            metrics.http_requests.inc(endpoint=endpoint, status='error')
+            raise
+        metrics.http_seconds.observe(time.time() - start_time, endpoint=endpoint)
+        metrics.http_requests.inc(endpoint=endpoint, status=resp.status_code)
+        metrics.http_bytes.inc(len(resp.content), endpoint=endpoint)
         lg.debug('Response: %s, %s', resp.status_code, resp.content[:100])
 
+        if cache_key and self.is_cacheable(resp):
+            self.cache.set(cache_key, resp)
+
         # wait for a little time, in case we are banned from the server
-        time.sleep(self.wait_time)
+        if not self.rate_limiter:
+            time.sleep(self.wait_time)
         return resp
 
+    def is_cacheable(self, resp):
+        return resp.status_code == 200
+
     def get(self, uri, *args, **kwargs):
         return self.request('get', uri, *args, **kwargs)
 
@@ -84,7 +140,8 @@ class HTTPClient:
 @contextmanager
 def response_context(resp):
     try:
-        yield None
+        with span('json'):
+            yield None
     except KeyError:
         print(f'response: {resp.content.decode("utf8")}')
         raise
@@ -93,6 +150,50 @@ def response_context(resp):
 class XiamiClient(HTTPClient):
     base_url = 'https://www.xiami.com'
     fav_uri = '/api/favorite/getFavorites'
+    token_retries = 3
+    # a callable that returns a new requests.Session with fresh cookies,
+    # used when the server does not refresh the token by Set-Cookie
+    token_loader = None
+
+    def api_get(self, uri, q):
+        """
+        Request a signed api, refresh the token and retry if the server says it's expired or invalid.
+        """
+        for i in range(self.token_retries + 1):
+            tk_value = get_token_value(self.session)
+            r = self.get(uri, params={
+                '_q': param_json_dump(q),
+                '_s': create_token(self.session, uri, q),
+            })
+            code = get_response_code(r)
+            if code not in TOKEN_ERROR_CODES:
+                return r
+            if i == self.token_retries:
+                break
+            lg.warning(f'{uri} responds {code}, refresh token and retry ({i + 1}/{self.token_retries})')
+            self.refresh_token(tk_value)
+        raise TokenError(f'failed to refresh token for {uri}: {r.content[:100]}')
+
+    def refresh_token(self, old_value):
+        # requests session stores the cookie from Set-Cookie,
+        # but the old one may still shadow it if they have different domains
+        for c in list(self.session.cookies):
+            if c.name == TOKEN_COOKIE_NAME and c.value != old_value:
+                lg.info(f'refresh token from Set-Cookie: {c.value}')
+                set_cookie_value(self.session.cookies, TOKEN_COOKIE_NAME, c.value)
+                return
+
+        if not self.token_loader:
+            lg.warning('token is not refreshed by Set-Cookie, and no token_loader to reload')
+            return
+        session = self.token_loader()
+        tk = get_cookie_from_cookiejar(session.cookies, TOKEN_COOKIE_NAME)
+        if tk:
+            lg.info(f'refresh token from token_loader: {tk.value}')
+            set_cookie_value(self.session.cookies, TOKEN_COOKIE_NAME, tk.value)
+
+    def is_cacheable(self, resp):
+        return resp.status_code == 200 and get_response_code(resp) == 'SUCCESS'
 
     # API methods
 
@@ -113,11 +214,7 @@ class XiamiClient(HTTPClient):
     def get_fav_songs(self, page, page_size=DEFAULT_PAGE_SIZE):
         lg.info(f'get_fav_songs: page={page}')
         q = self.make_page_q(page, page_size, FavType.SONGS)
-        params = {
-            '_q': param_json_dump(q),
-            '_s': create_token(self.session, self.fav_uri, q),
-        }
-        r = self.get(self.fav_uri, params=params)
+        r = self.api_get(self.fav_uri, q)
         # print(r.status_code, r.content.decode('utf-8'))
 
         # when out of max page, songs is "null"
@@ -128,11 +225,7 @@ class XiamiClient(HTTPClient):
     def get_fav_albums(self, page, page_size=DEFAULT_PAGE_SIZE):
         lg.info(f'get_fav_albums: page={page}')
         q = self.make_page_q(page, page_size, FavType.ALBUMS)
-        params = {
-            '_q': param_json_dump(q),
-            '_s': create_token(self.session, self.fav_uri, q),
-        }
-        r = self.get(self.fav_uri, params=params)
+        r = self.api_get(self.fav_uri, q)
         # print(r.status_code, r.content.decode('utf-8'))
 
         with response_context(r):
@@ -142,11 +235,7 @@ class XiamiClient(HTTPClient):
     def get_fav_artists(self, page, page_size=DEFAULT_PAGE_SIZE):
         lg.info(f'get_fav_albums: page={page}')
         q = self.make_page_q(page, page_size, FavType.ARTISTS)
-        params = {
-            '_q': param_json_dump(q),
-            '_s': create_token(self.session, self.fav_uri, q),
-        }
-        r = self.get(self.fav_uri, params=params)
+        r = self.api_get(self.fav_uri, q)
         # print(r.status_code, r.content.decode('utf-8'))
 
         with response_context(r):
@@ -156,11 +245,7 @@ class XiamiClient(HTTPClient):
     def get_fav_playlists(self, page, page_size=DEFAULT_PAGE_SIZE):
         lg.info(f'get_fav_playlists: page={page}')
         q = self.make_page_q(page, page_size, FavType.PLAYLISTS)
-        params = {
-            '_q': param_json_dump(q),
-            '_s': create_token(self.session, self.fav_uri, q),
-        }
-        r = self.get(self.fav_uri, params=params)
+        r = self.api_get(self.fav_uri, q)
         # print(r.status_code, r.content.decode('utf-8'))
 
         with response_context(r):
@@ -180,11 +265,7 @@ class XiamiClient(HTTPClient):
             "includeSystemCreate": 1,
             "sort": 0,
         }
-        params = {
-            '_q': param_json_dump(q),
-            '_s': create_token(self.session, uri, q),
-        }
-        r = self.get(uri, params=params)
+        r = self.api_get(uri, q)
         # print(r.status_code, r.content.decode('utf-8'))
 
         with response_context(r):
@@ -197,10 +278,7 @@ class XiamiClient(HTTPClient):
         q = {
             'songIds': song_ids,
         }
-        r = self.get(uri, params={
-            '_q': param_json_dump(q),
-            '_s': create_token(self.session, uri, q),
-        })
+        r = self.api_get(uri, q)
 
         with response_context(r):
             data = r.json()
@@ -213,10 +291,7 @@ class XiamiClient(HTTPClient):
         q = {
             'listId': pl_id,
         }
-        r_0 = self.get(uri_0, params={
-            '_q': param_json_dump(q),
-            '_s': create_token(self.session, uri_0, q),
-        })
+        r_0 = self.api_get(uri_0, q)
         data_0 = r_0.json()
 
         url = data_0['result']['data']['data']['data']['url']
@@ -231,10 +306,7 @@ class XiamiClient(HTTPClient):
         q = {
             'albumId': album_id,
         }
-        r = self.get(uri, params={
-            '_q': param_json_dump(q),
-            '_s': create_token(self.session, uri, q),
-        })
+        r = self.api_get(uri, q)
         with response_context(r):
             data = r.json()
             return data['result']['data']['albumDetail']
@@ -244,8 +316,23 @@ def param_json_dump(o):
     return json.dumps(o, separators=(',', ':'))
 
 
+def get_response_code(resp):
+    try:
+        data = resp.json()
+    except ValueError:
+        return None
+    if isinstance(data, dict):
+        return data.get('code')
+
+
+def get_token_value(session):
+    tk = get_cookie_from_cookiejar(session.cookies, TOKEN_COOKIE_NAME)
+    if tk:
+        return tk.value
+
+
 def create_token(session, path, q=None):
-    tk = get_cookie_from_cookiejar(session.cookies, 'xm_sg_tk')
+    tk = get_cookie_from_cookiejar(session.cookies, TOKEN_COOKIE_NAME)
     if not tk:
         raise ValueError('could not get xm_sg_tk from cookie')
     if q:
@@ -287,9 +374,15 @@ song_useless_keys = [
 
 
 def trim_song(d):
+    """
+    Returns True if any key is removed
+    """
+    changed = False
     for k in song_useless_keys:
         if k in d:
             del d[k]
+            changed = True
+    return changed
 
 
 album_useless_keys = [
@@ -301,6 +394,12 @@ album_useless_keys = [
 
 
 def trim_album(d):
+    """
+    Returns True if any key is removed
+    """
+    changed = False
     for k in album_useless_keys:
         if k in d:
             del d[k]
+            changed = True
+    return changed
@@ -0,0 +1,162 @@
+"""
+Collect audio files of song lists (albums, playlists) into dirs, e.g. music/albums/<id>-<name>/.
+
+The target tree is planned before touching any file: files of song lists are diffed against the files
+that already exist in their dirs, then only the differences are executed in a thread pool,
+so re-running on an unchanged library only lists the dirs.
+"""
+import os
+import re
+import json
+import errno
+import shutil
+import logging
+from collections import Counter
+from typing import Dict, List, NamedTuple, Optional
+from .catalog import parse_music_file_name
+from .os_util import ensure_dir, scan_files, atomic_write, get_temp_path
+from .profiling import span
+
+
+lg = logging.getLogger('xiami.collect')
+
+
+# how audio files are placed in song list dirs, falls back to copy if the file system does not support it
+MODES = ['hardlink', 'reflink', 'copy']
+
+# ioctl request of cloning a file on linux, see linux/fs.h
+FICLONE = 0x40049409
+
+# errors of linking that are fixed by copying instead
+LINK_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL}
+
+REGEX_STUB_FILE = re.compile(r'^\d+\.json$')
+
+
+class Target(NamedTuple):
+    # audio file to place, None for the json stub of a song that is not downloaded
+    src: Optional[str]
+    content: Optional[str] = None
+
+
+class Action(NamedTuple):
+    # create, update or remove
+    op: str
+    path: str
+    target: Optional[Target]
+
+
+def is_managed_file(file_name):
+    """
+    Files in song list dirs that are created by collect, other files are never removed.
+    """
+    return bool(REGEX_STUB_FILE.match(file_name)) or parse_music_file_name(file_name) is not None
+
+
+def is_up_to_date(entry: os.DirEntry, target: Target):
+    st = entry.stat()
+    if target.src is None:
+        # stubs are small, content is compared as a change may keep the size
+        content = target.content.encode('utf8')
+        if st.st_size != len(content):
+            return False
+        with open(entry.path, 'rb') as f:
+            return f.read() == content
+    src_st = os.stat(target.src)
+    if (st.st_dev, st.st_ino) == (src_st.st_dev, src_st.st_ino):
+        return True
+    # a copy is stale if the source is modified after it, e.g. tagged
+    return st.st_size == src_st.st_size and st.st_mtime_ns >= src_st.st_mtime_ns
+
+
+class CollectPlanner:
+    def __init__(self, files_dict):
+        # song_id -> (file_name, file_path), see FileStore.load_music_files
+        self.files_dict = files_dict
+        # dir path -> file name -> Target
+        self.tree: Dict[str, Dict[str, Target]] = {}
+
+    def add_song_list(self, dir_path, songs_data):
+        files = self.tree.setdefault(str(dir_path), {})
+        for song_data in songs_data:
+            song_id = song_data['songId']
+            if song_id in self.files_dict:
+                file_name, file_path = self.files_dict[song_id]
+                files[file_name] = Target(str(file_path))
+            else:
+                lg.debug(f'song file not found: {song_id}')
+                files[f'{song_id}.json'] = Target(None, json.dumps(song_data, ensure_ascii=False))
+
+    def diff(self) -> List[Action]:
+        actions = []
+        for dir_path, files in self.tree.items():
+            existing = {i.name: i for i in scan_files(dir_path)}
+            for file_name, target in files.items():
+                entry = existing.get(file_name)
+                if entry is None:
+                    actions.append(Action('create', os.path.join(dir_path, file_name), target))
+                elif not is_up_to_date(entry, target):
+                    actions.append(Action('update', entry.path, target))
+            for file_name, entry in existing.items():
+                # e.g. the stub of a song that is downloaded now
+                if file_name not in files and is_managed_file(file_name):
+                    actions.append(Action('remove', entry.path, None))
+        return actions
+
+
+def reflink(src, dst):
+    import fcntl
+
+    with open(src, 'rb') as src_f, open(dst, 'wb') as dst_f:
+        fcntl.ioctl(dst_f.fileno(), FICLONE, src_f.fileno())
+
+
+def place_file(src, dst, mode):
+    """
+    Place src at dst by mode, dst is replaced atomically if it exists. Returns the method actually used.
+    """
+    tmp_path = get_temp_path(dst)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    method = 'copy'
+    if mode in ('hardlink', 'reflink'):
+        try:
+            if mode == 'hardlink':
+                os.link(src, tmp_path)
+            else:
+                reflink(src, tmp_path)
+            method = mode
+        except (OSError, ImportError) as e:
+            if isinstance(e, OSError) and e.errno not in LINK_ERRNOS:
+                raise
+            lg.debug(f'{mode} not supported, copy {src}: {e!r}')
+    if method == 'copy':
+        shutil.copy2(src, tmp_path)
+    os.replace(tmp_path, dst)
+    return method
+
+
+def run_action(action: Action, mode) -> str:
+    """
+    Returns the name to count the action by
+    """
+    with span('disk'):
+        if action.op == 'remove':
+            os.remove(action.path)
+            return 'remove'
+        if action.target.src is None:
+            atomic_write(action.path, action.target.content)
+            return 'stub'
+        return place_file(action.target.src, action.path, mode)
+
+
+def execute(planner: CollectPlanner, actions: List[Action], mode='hardlink', workers=8) -> Counter:
+    from concurrent.futures import ThreadPoolExecutor
+
+    for dir_path in planner.tree:
+        ensure_dir(dir_path)
+    counter = Counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for method in executor.map(lambda action: run_action(action, mode), actions):
+            counter[method] += 1
+    return counter
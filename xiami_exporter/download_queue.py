@@ -0,0 +1,118 @@
+import datetime
+import logging
+from typing import List, Iterator
+from .models import db, Song
+
+
+lg = logging.getLogger('xiami.download_queue')
+
+
+class DownloadQueue:
+    """
+    Songs of a download status, claimed in batches by keyset pagination on (row_number, id).
+
+    Each claim is a short IMMEDIATE transaction that selects the next eligible songs after the last claimed one
+    and leases them by setting claimed_until, so that threads or processes sharing the database never download
+    the same song, and no cursor is kept open while songs are downloaded and updated.
+    The lease of the songs still waiting in a batch is renewed after each song is downloaded, so it only needs to
+    cover downloading one song. Songs claimed by a worker that crashed become eligible again when the lease expires.
+    """
+
+    def __init__(self, status, fav_only=False, lease=1800):
+        self.status = status
+        # only songs in fav songs, otherwise songs of song lists are included
+        self.fav_only = fav_only
+        self.lease = lease
+        # (row_number, id) of the last song claimed
+        self.last = (-1, -1)
+
+    def where_eligible(self, now):
+        where = (Song.download_status == self.status) & (Song.claimed_until.is_null() | (Song.claimed_until < now))
+        if self.fav_only:
+            where &= (Song.in_songs == True)  # NOQA
+        return where
+
+    def where_after(self, last):
+        row_number, song_id = last
+        return (Song.row_number > row_number) | ((Song.row_number == row_number) & (Song.id > song_id))
+
+    def next_page(self, size, last) -> List[tuple]:
+        """
+        (id, row_number) of the next size eligible songs after last
+        """
+        now = datetime.datetime.now()
+        return list(Song.select(Song.id, Song.row_number)
+                    .where(self.where_eligible(now) & self.where_after(last))
+                    .order_by(Song.row_number, Song.id)
+                    .limit(size)
+                    .tuples())
+
+    def claim(self, size) -> List[int]:
+        """
+        Returns ids of the claimed songs, an empty list means the queue is drained
+        """
+        with db.atomic(lock_type='IMMEDIATE'):
+            rows = self.next_page(size, self.last)
+            if rows:
+                claimed_until = datetime.datetime.now() + datetime.timedelta(seconds=self.lease)
+                Song.update(claimed_until=claimed_until).where(Song.id.in_([i[0] for i in rows])).execute()
+        if not rows:
+            return []
+        self.last = (rows[-1][1], rows[-1][0])
+        song_ids = [i[0] for i in rows]
+        lg.debug(f'claim {len(song_ids)} songs, last={self.last}')
+        return song_ids
+
+    def claim_ids(self, song_ids) -> List[int]:
+        """
+        Claim songs by ids regardless of status and order, e.g. songs to retry, returns ids not leased by others
+        """
+        now = datetime.datetime.now()
+        with db.atomic(lock_type='IMMEDIATE'):
+            claimed = [i[0] for i in Song.select(Song.id).where(
+                Song.id.in_(song_ids),
+                Song.claimed_until.is_null() | (Song.claimed_until < now),
+            ).tuples()]
+            if claimed:
+                claimed_until = now + datetime.timedelta(seconds=self.lease)
+                Song.update(claimed_until=claimed_until).where(Song.id.in_(claimed)).execute()
+        return claimed
+
+    def renew(self, song_ids):
+        """
+        Extend the lease of songs that are still claimed
+        """
+        if not song_ids:
+            return
+        claimed_until = datetime.datetime.now() + datetime.timedelta(seconds=self.lease)
+        Song.update(claimed_until=claimed_until).where(
+            Song.id.in_(song_ids), Song.claimed_until.is_null(False)).execute()
+
+    def release(self, song_ids):
+        """
+        Clear the lease of songs, unfinished songs could be claimed again by other workers
+        """
+        Song.update(claimed_until=None).where(Song.id.in_(song_ids)).execute()
+
+    def batches(self, size, claim=True) -> Iterator[List[int]]:
+        """
+        Yields batches of song ids until the queue is drained.
+
+        claim: lease the songs, otherwise only page through them, e.g. for estimating without downloading
+        """
+        if claim:
+            while True:
+                song_ids = self.claim(size)
+                if not song_ids:
+                    return
+                yield song_ids
+        last = self.last
+        while True:
+            rows = self.next_page(size, last)
+            if not rows:
+                return
+            last = (rows[-1][1], rows[-1][0])
+            yield [i[0] for i in rows]
+
+    def count(self):
+        return Song.select().where(self.where_eligible(datetime.datetime.now())).count()
@@ -1,9 +1,9 @@
 import os
 import datetime
 from typing import Optional
-from requests.cookies import create_cookie
 from http.cookiejar import Cookie
 from mimetypes import guess_extension
+from .os_util import atomic_open
 
 
 def cookie_to_dict(c: Cookie):
@@ -48,6 +48,8 @@ def create_cookie_from_dict(d: dict) -> Cookie:
     Turn cookie dict into arguments for requests.cookies.create_cookie, and returns the calling.
     """
 
+    from requests.cookies import create_cookie
+
     kwargs = dict(d)
     args = [kwargs.pop('name'), kwargs.pop('value')]
 
@@ -64,6 +66,17 @@ def get_cookie_from_cookiejar(cj, name) -> Optional[Cookie]:
             return i
 
 
+def set_cookie_value(cj, name, value):
+    """
+    Set cookie value by name, all the existing cookies with the same name are removed,
+    so that the value is not shadowed by cookies from other domains.
+    """
+    for i in list(cj):
+        if i.name == name:
+            cj.clear(i.domain, i.path, i.name)
+    cj.set(name, value)
+
+
 def cookie_str_to_dict(s: str):
     d = {}
     for i in s.split(';'):
@@ -97,16 +110,28 @@ def time_based_filename(ext):
     return f'{prefix}{ext}'
 
 
-def save_response_to_file(resp, file_path=None, dir_path=None, file_name=None, mode='wb', stream=False, block_size=1024 * 512, logger=None):
+def save_response_to_file(resp, file_path=None, dir_path=None, file_name=None, mode='wb', stream=False, block_size=1024 * 512, logger=None, throttle=None):
+    """
+    Returns the number of bytes written.
+
+    throttle: bandwidth.Throttle, limit the rate of reading from a stream response
+    """
     if not file_path and not dir_path:
         raise ValueError('file_path and dir_path must have at least one')
     if not file_path:
         file_path = os.path.join(dir_path, file_name)
     if logger:
         logger.info(f'save response to {file_path}')
-    with open(file_path, mode) as f:
+    # write to a temp file first, an interrupted download never leaves a partial file
+    size = 0
+    with atomic_open(file_path, mode) as f:
         if stream:
             for block in resp.iter_content(block_size):
                 f.write(block)
+                size += len(block)
+                if throttle:
+                    throttle.consume(len(block))
         else:
             f.write(resp.content)
+            size = len(resp.content)
+    return size
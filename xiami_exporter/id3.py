@@ -1,14 +1,14 @@
-from typing import Union
+from typing import Union, NamedTuple
 import logging
 from io import BytesIO
 from pathlib import Path
 from mutagen.easyid3 import EasyID3
 from mutagen.easymp4 import EasyMP4
-from mutagen.id3 import ID3, COMM, APIC
+from mutagen.id3 import ID3, COMM, APIC, USLT
 from mutagen.mp4 import MP4
 from mutagen.id3._util import ID3NoHeaderError
-from PIL import Image
 from .models import Song
+from .profiling import span
 
 
 lg = logging.getLogger()
@@ -18,10 +18,6 @@ extra_id3_tags = [
 ]
 
 
-for k, v in extra_id3_tags:
-    EasyID3.RegisterTextKey(k, v)
-
-
 def comment_get(id3, key):
     return id3["COMM"]._pprint()
 
@@ -47,23 +43,17 @@ def comment_delete(id3, key):
     del(id3["COMM"])
 
 
-EasyID3.RegisterKey("comment", comment_get, comment_set, comment_delete)
-
-
 def cover_get(id3, key):
     return id3['APIC'].type
 
 
-def cover_set(id3, key, img: Image):
-    buf = BytesIO()
-    img.save(buf, format=img.format)
-
+def cover_set(id3, key, cover):
     id3['APIC'] = APIC(
         encoding=3,  # 3 is for utf-8
-        mime=Image.MIME[img.format],  # image/jpeg or image/png
+        mime=cover.mime,  # image/jpeg or image/png
         type=3,  # 3 is for the cover image
         desc='',
-        data=buf.getvalue(),
+        data=cover.data,
     )
 
 
@@ -71,10 +61,43 @@ def cover_delete(id3, key):
     del(id3['APIC'])
 
 
-EasyID3.RegisterKey('cover', cover_get, cover_set, cover_delete)
+def lyrics_get(id3, key):
+    return [i.text for i in id3.getall('USLT')]
+
+
+def lyrics_set(id3, key, value):
+    id3.setall('USLT', [USLT(
+        encoding=3,
+        lang='chi',
+        desc='',
+        text=value[0],
+    )])
+
+
+def lyrics_delete(id3, key):
+    id3.delall('USLT')
+
+
+_easyid3_keys_registered = False
+
+
+def register_easyid3_keys():
+    """
+    EasyID3 keys are registered when the first mp3 is loaded, instead of at import time
+    """
+    global _easyid3_keys_registered
+    if _easyid3_keys_registered:
+        return
+    for k, v in extra_id3_tags:
+        EasyID3.RegisterTextKey(k, v)
+    EasyID3.RegisterKey("comment", comment_get, comment_set, comment_delete)
+    EasyID3.RegisterKey('cover', cover_get, cover_set, cover_delete)
+    EasyID3.RegisterKey('lyrics', lyrics_get, lyrics_set, lyrics_delete)
+    _easyid3_keys_registered = True
 
 
 def load_mp3(file_name, easy=True):
+    register_easyid3_keys()
     try:
         if easy:
             return EasyID3(file_name)
@@ -88,6 +111,7 @@ def load_mp3(file_name, easy=True):
 
 
 def load_m4a(file_name, easy=True):
+    EasyMP4.RegisterTextKey('lyrics', '\xa9lyr')
     if easy:
         return EasyMP4(file_name)
     else:
@@ -117,14 +141,42 @@ DEFAULT_KEY_MAP = {
     'arrangement': 'involvedpeople',  # TIPL
 }
 
-COVER_CACHE = {}
+# Song fields read by Tagger.tag_by_model and tag-music
+TAG_FIELDS = ['id', 'album_id', 'singers', 'album_sub_name', 'artist_alias'] + list(DEFAULT_KEY_MAP)
+
+
+class Cover(NamedTuple):
+    mime: str
+    data: bytes
+
+
+def load_cover(file_path: Path) -> Cover:
+    """
+    Read a cover image once for all tracks of its album, images larger than 512KiB are resized
+    """
+    from PIL import Image
+
+    with span('image'):
+        img = Image.open(file_path)
+        fmt = img.format
+        if file_path.stat().st_size > 512 * 1024:
+            lg.debug(f'create thumbnail for image {file_path}')
+            img.thumbnail((500, 500))
+            buf = BytesIO()
+            img.save(buf, format=fmt)
+            data = buf.getvalue()
+        else:
+            data = file_path.read_bytes()
+        img.close()
+    return Cover(Image.MIME[fmt], data)
 
 
 class Tagger:
     def __init__(self, file_path: Union[Path, str]):
         self.file_path = Path(file_path)
         self.mutagen_factory = SUPPORT_EXTS[self.file_path.suffix]
-        self.mutagen_obj = self.mutagen_factory(self.file_path)
+        with span('tag'):
+            self.mutagen_obj = self.mutagen_factory(self.file_path)
         # lg.debug('mutagen obj: %s', self.mutagen_obj)
         self.key_map = DEFAULT_KEY_MAP
 
@@ -136,6 +188,10 @@ class Tagger:
         return None
 
     def tag_by_model(self, song: Song, clear_old=False):
+        with span('tag'):
+            self._tag_by_model(song, clear_old)
+
+    def _tag_by_model(self, song: Song, clear_old=False):
         lg.debug(f'Tag song: {self.file_path.name}')
 
         if clear_old:
@@ -169,21 +225,19 @@ class Tagger:
         if comment_l:
             self.mutagen_obj['comment'] = '; '.join(comment_l)
 
-    def tag_cover(self, file_path: Path):
-        img = Image.open(file_path)
-        # if larger than 512KiB, resize
-        if file_path.stat().st_size > 512 * 1024:
-            if file_path in COVER_CACHE:
-                img = COVER_CACHE[file_path]
-            else:
-                lg.debug(f'create thumbnail for image {file_path}')
-                img.thumbnail((500, 500))
-                COVER_CACHE[file_path] = img
+    def tag_cover(self, cover: Union[Cover, Path]):
+        if not isinstance(cover, Cover):
+            cover = load_cover(cover)
+        with span('tag'):
+            self.mutagen_obj['cover'] = cover
 
-        self.mutagen_obj['cover'] = img
+    def tag_lyrics(self, text: str):
+        with span('tag'):
+            self.mutagen_obj['lyrics'] = text
 
     def save(self):
-        self.mutagen_obj.save()
+        with span('disk'):
+            self.mutagen_obj.save()
 
     def show_tags(self):
         obj = self.mutagen_factory(self.file_path, easy=False)
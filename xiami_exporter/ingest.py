@@ -0,0 +1,91 @@
+import logging
+from .models import db, create_song, Song, SongList, SongListType
+
+
+lg = logging.getLogger('xiami.ingest')
+
+
+# Song field that marks songs of a song list type
+SONG_LIST_FLAGS = {
+    SongListType.ALBUM: 'in_albums',
+    SongListType.PLAYLIST: 'in_playlists',
+}
+
+
+def get_songs_by_ids(song_ids, columns=None):
+    """
+    columns: only select these fields, rows are named tuples instead of Song models
+    """
+    songs = {}
+    # sqlite has a limit on the number of variables
+    for i in range(0, len(song_ids), 500):
+        if columns:
+            q = Song.select(*columns).where(Song.id.in_(song_ids[i:i + 500])).namedtuples()
+        else:
+            q = Song.select().where(Song.id.in_(song_ids[i:i + 500]))
+        for song in q:
+            songs[song.id] = song
+    return songs
+
+
+def ingest_fav_songs(songs_data, row_number_start=1):
+    """
+    Upsert songs of a fav songs page, row numbers start from row_number_start.
+
+    Existing songs keep their download status and row number, they are only marked in_songs.
+    Returns the number of created songs.
+    """
+    existing = get_songs_by_ids([i['songId'] for i in songs_data])
+    created_ids = set()
+    with db.atomic():
+        for i, data in enumerate(songs_data):
+            row_number = row_number_start + i
+            song_id = data['songId']
+            song = existing.get(song_id)
+            if song:
+                if not song.in_songs or not song.row_number:
+                    song.in_songs = True
+                    song.row_number = song.row_number or row_number
+                    song.save()
+            elif song_id not in created_ids:
+                create_song(data, row_number)
+                created_ids.add(song_id)
+    return len(created_ids)
+
+
+def ingest_song_list(list_type, list_id, songs_data):
+    """
+    Upsert songs of an album or playlist detail, and replace the song_list rows of it,
+    so that songs removed from the list are dropped and rows follow the order of the list.
+
+    Returns the number of created songs.
+    """
+    flag = SONG_LIST_FLAGS[list_type]
+    existing = get_songs_by_ids([i['songId'] for i in songs_data])
+    listed = set()
+    created_ids = set()
+    new_rows = []
+    with db.atomic():
+        for data in songs_data:
+            song_id = data['songId']
+            song = existing.get(song_id)
+            if song:
+                if not getattr(song, flag):
+                    setattr(song, flag, True)
+                    song.save()
+            elif song_id not in created_ids:
+                try:
+                    create_song(data, 0, {flag: True})
+                except Exception:
+                    lg.error(f'create_song error: {list_type}={list_id} song_id={song_id}')
+                    raise
+                created_ids.add(song_id)
+            if song_id not in listed:
+                listed.add(song_id)
+                new_rows.append(
+                    {'list_type': list_type, 'list_id': list_id, 'song_id': song_id, 'position': len(new_rows)})
+        SongList.delete().where(SongList.list_type == list_type, SongList.list_id == list_id).execute()
+        for i in range(0, len(new_rows), 100):
+            SongList.insert_many(new_rows[i:i + 100]).execute()
+    lg.debug(f'ingest {list_type} {list_id}: songs={len(songs_data)} created={len(created_ids)}')
+    return len(created_ids)
@@ -0,0 +1,92 @@
+import datetime
+import logging
+from typing import Optional, List
+from .models import JobItem, JobState
+
+
+lg = logging.getLogger('xiami.journal')
+
+
+class Journal:
+    """
+    Persistent per-item state of a job, so that an interrupted run can continue where it stopped.
+    """
+
+    def __init__(self, job):
+        self.job = job
+
+    def get(self, key) -> Optional[JobItem]:
+        return JobItem.get_or_none(JobItem.job == self.job, JobItem.key == str(key))
+
+    def get_state(self, key):
+        item = self.get(key)
+        if item:
+            return item.state
+
+    def is_done(self, key):
+        return self.get_state(key) == JobState.DONE
+
+    def _upsert(self, key, state, error='', attempt=False, next_at=None):
+        now = datetime.datetime.now()
+        update = {
+            JobItem.state: state,
+            JobItem.error: error,
+            JobItem.next_at: next_at,
+            JobItem.updated_at: now,
+        }
+        if attempt:
+            update[JobItem.attempts] = JobItem.attempts + 1
+        JobItem.insert(
+            job=self.job, key=str(key), state=state, error=error,
+            attempts=1 if attempt else 0, next_at=next_at, updated_at=now,
+        ).on_conflict(
+            conflict_target=[JobItem.job, JobItem.key],
+            update=update,
+        ).execute()
+
+    def start(self, key):
+        self._upsert(key, JobState.IN_FLIGHT, attempt=True)
+
+    def done(self, key):
+        self._upsert(key, JobState.DONE)
+
+    def fail(self, key, error, retry_delay=None):
+        """
+        retry_delay: seconds after which the item could be retried, None means no retry
+        """
+        next_at = None
+        if retry_delay is not None:
+            next_at = datetime.datetime.now() + datetime.timedelta(seconds=retry_delay)
+        self._upsert(key, JobState.FAILED, error=str(error), next_at=next_at)
+
+    def keys(self, state) -> List[str]:
+        q = JobItem.select(JobItem.key).where(JobItem.job == self.job, JobItem.state == state)
+        return [i.key for i in q]
+
+    def retryable_keys(self, max_attempts) -> List[str]:
+        """
+        failed items that could be retried now
+        """
+        q = JobItem.select(JobItem.key).where(
+            JobItem.job == self.job,
+            JobItem.state == JobState.FAILED,
+            JobItem.attempts < max_attempts,
+            JobItem.next_at.is_null(False),
+            JobItem.next_at <= datetime.datetime.now(),
+        )
+        return [i.key for i in q]
+
+    def recover(self):
+        """
+        items left in-flight are from a run that crashed, set them back to pending
+        """
+        n = (JobItem
+             .update(state=JobState.PENDING, updated_at=datetime.datetime.now())
+             .where(JobItem.job == self.job, JobItem.state == JobState.IN_FLIGHT)
+             .execute())
+        if n:
+            lg.info(f'journal {self.job}: {n} items were interrupted in last run, set to pending')
+        return n
+
+    def reset(self):
+        JobItem.delete().where(JobItem.job == self.job).execute()
@@ -0,0 +1,103 @@
+"""
+Lyric files of songs, downloaded from ``lyricInfo.lyricFile`` of song json to lyrics/<song_id>.<ext>,
+then embedded into audio files by tag-music.
+"""
+import os
+import re
+import logging
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+from .http_util import save_response_to_file
+from .os_util import ensure_dir, scan_files, atomic_write
+from .retry import TRANSIENT_STATUS_CODES
+from . import metrics
+
+
+lg = logging.getLogger('xiami.lyrics')
+
+
+# lrc: lines with time tags, trc: lrc with word time tags like <120>, x*: xiami variants of them
+LYRIC_EXTS = ['.lrc', '.trc', '.xlrc', '.xtrc']
+
+REGEX_WORD_TIME = re.compile(r'<\d+>')
+
+
+def get_lyric_url(song_data) -> str:
+    info = song_data.get('lyricInfo') or {}
+    return info.get('lyricFile') or ''
+
+
+def get_lyric_file_name(song_id, url):
+    ext = os.path.splitext(urlparse(url).path)[1].lower()
+    if ext not in LYRIC_EXTS:
+        ext = '.lrc'
+    return f'{song_id}{ext}'
+
+
+def lyric_text(raw: bytes) -> str:
+    """
+    Text to embed, word time tags are removed and line time tags are kept, as most players read lrc from the tag.
+    """
+    text = raw.decode('utf8', errors='replace').lstrip('﻿')
+    text = REGEX_WORD_TIME.sub('', text)
+    return '\n'.join(line.rstrip() for line in text.splitlines()).strip()
+
+
+def find_lyric_files(lyrics_dir) -> Dict[int, str]:
+    """
+    song_id -> file path, an empty file marks the lyric as unavailable
+    """
+    rv = {}
+    for entry in scan_files(lyrics_dir):
+        song_id, ext = os.path.splitext(entry.name)
+        if ext in LYRIC_EXTS and song_id.isdigit():
+            rv[int(song_id)] = entry.path
+    return rv
+
+
+def download_lyric(client, song_id, url, lyrics_dir) -> int:
+    """
+    Returns the number of bytes saved, 0 if the lyric file is not available, -1 if it could be retried by next run
+    """
+    resp = client.get(url, is_absolute_url=True)
+    if resp.status_code in TRANSIENT_STATUS_CODES:
+        lg.warning(f'failed to download lyric of {song_id}: {resp.status_code} {url}')
+        metrics.download_lyrics.inc(status='failed')
+        return -1
+    if resp.status_code != 200:
+        lg.warning(f'lyric of {song_id} not available: {resp.status_code} {url}')
+        metrics.download_lyrics.inc(status='unavailable')
+        # an empty file, so that it is skipped as existing by next run
+        atomic_write(os.path.join(lyrics_dir, get_lyric_file_name(song_id, url)), b'', mode='wb')
+        return 0
+    size = save_response_to_file(resp, dir_path=lyrics_dir, file_name=get_lyric_file_name(song_id, url))
+    metrics.download_lyrics.inc(status='done')
+    return size
+
+
+def download_lyrics(client, items: List[Tuple[int, str]], lyrics_dir, workers=4) -> Tuple[int, int]:
+    """
+    Download lyrics of (song_id, url) items in a thread pool, the rate of requests is limited by the client.
+    Returns (number of files saved, number of failures)
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    ensure_dir(lyrics_dir)
+
+    def download(item):
+        song_id, url = item
+        try:
+            return download_lyric(client, song_id, url, lyrics_dir)
+        except Exception as e:
+            lg.error(f'failed to download lyric of {song_id}:\n  url={url}\n  error={e!r}')
+            metrics.download_lyrics.inc(status='failed')
+            return -1
+
+    saved, failed = 0, 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for size in executor.map(download, items):
+            if size > 0:
+                saved += 1
+            elif size < 0:
+                failed += 1
+    return saved, failed
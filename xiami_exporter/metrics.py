@@ -0,0 +1,258 @@
+"""
+Counters, gauges and histograms of a run, e.g. requests, bytes and latency per endpoint.
+
+Metrics are collected in the global ``registry``, and could be written to a file
+in prometheus text format or as json lines by ``MetricsWriter``.
+"""
+import sys
+import json
+import time
+import bisect
+import threading
+from typing import Dict, Tuple
+from urllib.parse import urlparse
+from .os_util import atomic_write
+
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def labels_key(labels: dict) -> Tuple:
+    return tuple(sorted(labels.items()))
+
+
+def format_labels(key: Tuple, extra=None) -> str:
+    items = list(key) + list(extra or [])
+    if not items:
+        return ''
+    s = ','.join(f'{k}="{v}"' for k, v in items)
+    return '{' + s + '}'
+
+
+class Metric:
+    type = ''
+
+    def __init__(self, name, help=''):
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple, float] = {}
+
+    def get(self, **labels):
+        return self.values.get(labels_key(labels), 0)
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for key, v in sorted(self.values.items()):
+            lines.append(f'{self.name}{format_labels(key)} {v}')
+        return lines
+
+    def to_dict(self):
+        return {format_labels(k) or '': v for k, v in self.values.items()}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, n=1, **labels):
+        key = labels_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, v, **labels):
+        with self.lock:
+            self.values[labels_key(labels)] = v
+
+    def inc(self, n=1, **labels):
+        key = labels_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help='', buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+        # labels key -> [bucket counts..., +Inf count]
+        self.counts: Dict[Tuple, list] = {}
+
+    def observe(self, v, **labels):
+        key = labels_key(labels)
+        with self.lock:
+            counts = self.counts.get(key)
+            if counts is None:
+                counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            counts[bisect.bisect_left(self.buckets, v)] += 1
+            # values holds the sum
+            self.values[key] = self.values.get(key, 0) + v
+
+    def count(self, **labels):
+        return sum(self.counts.get(labels_key(labels), []))
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        for key, counts in sorted(self.counts.items()):
+            acc = 0
+            for le, c in zip(list(self.buckets) + ['+Inf'], counts):
+                acc += c
+                lines.append(f'{self.name}_bucket{format_labels(key, [("le", le)])} {acc}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {self.values[key]}')
+            lines.append(f'{self.name}_count{format_labels(key)} {acc}')
+        return lines
+
+    def to_dict(self):
+        return {
+            format_labels(k) or '': {'sum': self.values[k], 'count': sum(c)}
+            for k, c in self.counts.items()
+        }
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, help, **kwargs):
+        with self.lock:
+            m = self.metrics.get(name)
+            if m is None:
+                m = self.metrics[name] = cls(name, help, **kwargs)
+            return m
+
+    def counter(self, name, help='') -> Counter:
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help='') -> Gauge:
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render_prometheus(self):
+        lines = []
+        for m in self.metrics.values():
+            lines.extend(m.render())
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        return {name: m.to_dict() for name, m in self.metrics.items()}
+
+
+registry = Registry()
+
+http_requests = registry.counter('xiami_http_requests_total', 'http requests by endpoint and status')
+http_seconds = registry.histogram('xiami_http_request_seconds', 'http request latency by endpoint')
+http_bytes = registry.counter('xiami_http_response_bytes_total', 'http response bytes by endpoint')
+http_cache_hits = registry.counter('xiami_http_cache_hits_total', 'http responses served by cache')
+download_songs = registry.counter('xiami_download_songs_total', 'downloaded songs by status')
+download_bytes = registry.counter('xiami_download_bytes_total', 'downloaded audio bytes')
+download_seconds = registry.histogram('xiami_download_seconds', 'time to download a song')
+queue_depth = registry.gauge('xiami_queue_depth', 'items waiting in the queue')
+export_items = registry.counter('xiami_export_items_total', 'exported items by fav type')
+download_lyrics = registry.counter('xiami_download_lyrics_total', 'downloaded lyric files by status')
+
+
+def endpoint_label(url):
+    """
+    api uri for api requests, host for cdn requests whose paths are unique
+    """
+    url_parsed = urlparse(url)
+    if url_parsed.path.startswith('/api/'):
+        return url_parsed.path
+    return url_parsed.netloc
+
+
+class MetricsWriter:
+    """
+    Write metrics to file periodically in a background thread, and once more when stopped.
+
+    fmt: prom, the file is replaced by the latest metrics in prometheus text format;
+         jsonl, a snapshot is appended as a json line each time.
+    """
+
+    def __init__(self, file_path, fmt='prom', interval=10):
+        self.file_path = file_path
+        self.fmt = fmt
+        self.interval = interval
+        self.start_time = time.time()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def write(self):
+        if self.fmt == 'jsonl':
+            d = {
+                'time': time.time(),
+                'elapsed': time.time() - self.start_time,
+                'metrics': registry.to_dict(),
+            }
+            with open(self.file_path, 'a') as f:
+                f.write(json.dumps(d, ensure_ascii=False) + '\n')
+        else:
+            atomic_write(self.file_path, registry.render_prometheus())
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.write()
+
+
+class Progress:
+    """
+    Single line progress bar on stderr, with throughput from the metrics.
+    """
+
+    def __init__(self, total, label='', enabled=True, width=30):
+        self.total = total
+        self.label = label
+        self.enabled = enabled
+        self.width = width
+        self.done = 0
+        self.start_time = time.time()
+        self.start_bytes = download_bytes.total()
+        self.start_requests = http_requests.total()
+        self.rendered_at = 0
+
+    def update(self, n=1):
+        self.done += n
+        queue_depth.set(max(self.total - self.done, 0))
+        if self.enabled and time.time() - self.rendered_at > 0.2:
+            self.render()
+
+    def render(self):
+        self.rendered_at = time.time()
+        elapsed = max(self.rendered_at - self.start_time, 0.001)
+        ratio = self.done / self.total if self.total else 1
+        filled = int(self.width * min(ratio, 1))
+        mb_per_sec = (download_bytes.total() - self.start_bytes) / 1024 / 1024 / elapsed
+        req_per_sec = (http_requests.total() - self.start_requests) / elapsed
+        failures = download_songs.get(status='FAILED') + download_songs.get(status='UNAVAILABLE')
+        eta = ''
+        if self.done and self.total > self.done:
+            eta = f' eta {int(elapsed / self.done * (self.total - self.done))}s'
+        line = (f'\r{self.label} [{"#" * filled}{"." * (self.width - filled)}] {self.done}/{self.total} '
+                f'{mb_per_sec:.2f}MB/s {req_per_sec:.1f}req/s failures {int(failures)}{eta}')
+        sys.stderr.write(line.ljust(100))
+        sys.stderr.flush()
+
+    def close(self):
+        if self.enabled:
+            self.render()
+            sys.stderr.write('\n')
@@ -7,7 +7,7 @@ from .models import db, all_models, Migration
 from .store import FileStore
 
 
-schema_version = 4
+schema_version = 11
 
 lg = logging.getLogger('xiami.db')
 
@@ -47,7 +47,7 @@ def migrate(fs: FileStore):
             return
 
         for ver in range(latest_version + 1, schema_version + 1):
-            migration_name = f'migration_00{ver}'
+            migration_name = f'migration_{ver:03d}'
             migration_func = globals().get(migration_name)
             if migration_func:
                 print(f'\nRunning migration {migration_name}')
@@ -113,3 +113,99 @@ def migration_004(fs):
             table_name = 'song_list'
 
     db.create_tables([SongList])
+
+
+def migration_005(fs):
+    """
+    - add job_item table
+    - add song_list table if missing, databases created by version 4 missed it
+    """
+    class SongList(BaseModel):
+        list_type = pw.CharField()
+        list_id = pw.IntegerField()
+        song_id = pw.IntegerField()
+
+        class Meta:
+            table_name = 'song_list'
+
+    class JobItem(BaseModel):
+        job = pw.CharField()
+        key = pw.CharField()
+        state = pw.IntegerField(default=0)
+        attempts = pw.IntegerField(default=0)
+        error = pw.TextField(default='')
+        updated_at = pw.DateTimeField()
+
+        class Meta:
+            table_name = 'job_item'
+            indexes = (
+                (('job', 'key'), True),
+            )
+
+    db.create_tables([SongList, JobItem])
+
+
+def migration_006(fs):
+    """
+    - job_item: add next_at field
+    """
+    pw_migrate.migrate(
+        migrator.add_column('job_item', 'next_at', pw.DateTimeField(null=True)),
+    )
+
+
+def migration_007(fs):
+    """
+    - add music_file table
+    """
+    class MusicFile(BaseModel):
+        path = pw.CharField(primary_key=True)
+        dir = pw.CharField(index=True)
+        file_name = pw.CharField()
+        song_id = pw.IntegerField(index=True)
+        size = pw.IntegerField()
+        mtime = pw.IntegerField()
+        hash = pw.CharField(default='')
+
+        class Meta:
+            table_name = 'music_file'
+
+    db.create_tables([MusicFile])
+
+
+def migration_008(fs):
+    """
+    - song: add file_size field
+    """
+    pw_migrate.migrate(
+        migrator.add_column('song', 'file_size', pw.IntegerField(default=0)),
+    )
+
+
+def migration_009(fs):
+    """
+    - song: add quality and audio_format fields
+    """
+    pw_migrate.migrate(
+        migrator.add_column('song', 'quality', pw.CharField(default='')),
+        migrator.add_column('song', 'audio_format', pw.CharField(default='')),
+    )
+
+
+def migration_010(fs):
+    """
+    - song: add claimed_until field, and index for the download queue
+    """
+    pw_migrate.migrate(
+        migrator.add_column('song', 'claimed_until', pw.DateTimeField(null=True)),
+        migrator.add_index('song', ('download_status', 'row_number', 'id'), False),
+    )
+
+
+def migration_011(fs):
+    """
+    - song_list: add position field, rows are in order of id until the song list is ingested again
+    """
+    pw_migrate.migrate(
+        migrator.add_column('song_list', 'position', pw.IntegerField(default=0)),
+    )
@@ -1,10 +1,21 @@
+import logging
 import peewee
-from peewee import CharField, IntegerField, BooleanField, DateTimeField
+from peewee import CharField, IntegerField, BooleanField, DateTimeField, TextField
 from peewee import DoesNotExist  # NOQA
+from .profiling import span
+
+
+lg = logging.getLogger('xiami.models')
+
+
+class Database(peewee.SqliteDatabase):
+    def execute_sql(self, *args, **kwargs):
+        with span('db'):
+            return super().execute_sql(*args, **kwargs)
 
 
 # http://docs.peewee-orm.com/en/latest/peewee/database.html#run-time-database-configuration
-db = peewee.SqliteDatabase(None)
+db = Database(None)
 
 
 class BaseModel(peewee.Model):
@@ -43,9 +54,22 @@ class Song(BaseModel):
 
     # export meta
     download_status = IntegerField()
+    # fileSize of the selected play info, set by downloading or estimating
+    file_size = IntegerField(default=0)
+    # quality (l, h, s) and format (mp3, m4a...) of the downloaded play info
+    quality = CharField(default='')
+    audio_format = CharField(default='')
     in_songs = BooleanField(default=False)
     in_albums = BooleanField(default=False)
     in_playlists = BooleanField(default=False)
+    # lease of a download worker that claimed the song, see download_queue.DownloadQueue
+    claimed_until = DateTimeField(null=True)
+
+    class Meta:
+        indexes = (
+            # keyset pagination of the download queue
+            (('download_status', 'row_number', 'id'), False),
+        )
 
     def __str__(self):
         return f'{self.id}: {self.name} - {self.artist_name} - {self.album_name}'
@@ -55,6 +79,8 @@ class SongList(BaseModel):
     list_type = CharField()
     list_id = IntegerField()
     song_id = IntegerField()
+    # index of the song in the song list
+    position = IntegerField(default=0)
 
     class Meta:
         table_name = 'song_list'
@@ -85,8 +111,66 @@ class DownloadStatus:
         return ''
 
 
+class JobState:
+    PENDING = 0
+    IN_FLIGHT = 1
+    DONE = 2
+    FAILED = -9
+
+    @classmethod
+    def to_str(cls, v):
+        for k, _v in cls.__dict__.items():
+            if v == _v:
+                return k
+        return ''
+
+
+class JobItem(BaseModel):
+    """
+    Progress of an item in a long-running job, e.g. a page of export or a song of download.
+    """
+    job = CharField()
+    key = CharField()
+    state = IntegerField(default=JobState.PENDING)
+    attempts = IntegerField(default=0)
+    error = TextField(default='')
+    # when the failed item could be retried
+    next_at = DateTimeField(null=True)
+    updated_at = DateTimeField()
+
+    class Meta:
+        table_name = 'job_item'
+        indexes = (
+            (('job', 'key'), True),
+        )
+
+    def __str__(self):
+        return f'{self.job}-{self.key}: {JobState.to_str(self.state)}'
+
+
+class MusicFile(BaseModel):
+    """
+    Catalog of music files, path is relative to music_dir.
+    """
+    path = CharField(primary_key=True)
+    dir = CharField(index=True)
+    file_name = CharField()
+    song_id = IntegerField(index=True)
+    size = IntegerField()
+    # st_mtime_ns
+    mtime = IntegerField()
+    # sha1 of file content, empty if not computed
+    hash = CharField(default='')
+
+    class Meta:
+        table_name = 'music_file'
+
+    def __str__(self):
+        return f'{self.song_id}: {self.path}'
+
+
 def create_song(data, row_number, attrs=None) -> Song:
-    print(f'create_song: songId={data.get("songId")}')
+    lg.debug(f'create_song: songId={data.get("songId")}')
     # artistId might be empty
     if not data.get('artistId'):
         data['artistId'] = 0
@@ -129,4 +213,4 @@ class Migration(BaseModel):
     applied_at = DateTimeField()
 
 
-all_models = [Song, Migration]
+all_models = [Song, SongList, JobItem, MusicFile, Migration]
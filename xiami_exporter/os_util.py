@@ -1,6 +1,9 @@
 import os
 import re
 import logging
+from typing import List
+from contextlib import contextmanager
+from .profiling import span
 
 
 lg = logging.getLogger('xiami.os_util')
@@ -19,18 +22,95 @@ def ensure_dir(path):
             lg.info('ignore os.makedirs OSError: %s', e)
 
 
+def get_temp_path(file_path):
+    """
+    Temp file for atomic writes, prefixed by a dot so that it's not matched by ROW_NUMBER-SONG_ID pattern
+    """
+    dir_path, file_name = os.path.split(str(file_path))
+    return os.path.join(dir_path, f'.{file_name}.tmp')
+
+
+@contextmanager
+def atomic_open(file_path, mode='w'):
+    """
+    Write to a temp file and rename it to file_path when finished,
+    so that file_path is either complete or not existing even if the process crashes.
+    """
+    tmp_path = get_temp_path(file_path)
+    try:
+        with open(tmp_path, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, file_path)
+
+
+def atomic_write(file_path, content, mode='w'):
+    with span('disk'), atomic_open(file_path, mode) as f:
+        f.write(content)
+
+
 REGEX_FILE_NUMBER = re.compile(r'\d+')
 
 
-def dir_files_sorted(dir_path):
-    _, _, files = next(os.walk(dir_path))
-    files.sort(key=lambda x: int(re.search(REGEX_FILE_NUMBER, x).group()))
-    for i in files:
-        yield i
+def file_number_key(file_name):
+    """
+    Sort key by the first number in file name, e.g. songs-12.json -> 12, 12345.json -> 12345,
+    files without number are put at the end.
+    """
+    rv = REGEX_FILE_NUMBER.search(file_name)
+    if rv:
+        return (0, int(rv.group()), file_name)
+    return (1, 0, file_name)
+
+
+def scan_files(dir_path) -> List[os.DirEntry]:
+    """
+    Files in dir_path as DirEntry objects, whose stat info could be reused.
+    Hidden files (including temp files of atomic writes) are skipped, missing dir is treated as empty.
+    """
+    try:
+        it = os.scandir(dir_path)
+    except FileNotFoundError:
+        return []
+    with it:
+        return [i for i in it if not i.name.startswith('.') and i.is_file()]
+
+
+# dir_path -> (st_mtime_ns, sorted file names)
+_sorted_files_cache = {}
+
+
+def dir_files_sorted(dir_path, cached=False) -> List[str]:
+    """
+    File names in dir_path sorted by number in name.
+
+    cached: reuse the listing if the mtime of dir is not changed since last call,
+            adding, removing or renaming files in a dir changes its mtime.
+    """
+    key = str(dir_path)
+    mtime = None
+    if cached:
+        try:
+            mtime = os.stat(key).st_mtime_ns
+        except FileNotFoundError:
+            return []
+        rv = _sorted_files_cache.get(key)
+        if rv and rv[0] == mtime:
+            # a copy, callers may modify the list
+            return list(rv[1])
+
+    files = [i.name for i in scan_files(dir_path)]
+    files.sort(key=file_number_key)
+    if cached:
+        _sorted_files_cache[key] = (mtime, tuple(files))
+    return files
 
 
 def dir_files(dir_path):
-    with os.scandir(dir_path) as dir_entries:
-        for i in dir_entries:
-            if i.is_file():
-                yield i.name
+    for i in scan_files(dir_path):
+        yield i.name
@@ -0,0 +1,126 @@
+"""
+Write song lists as playlist files (M3U8, XSPF) that refer to the audio files in music dir by relative paths,
+instead of placing the audio files in a dir for each song list.
+"""
+import os
+import logging
+from itertools import groupby
+from typing import Dict, List, NamedTuple
+from urllib.parse import quote
+from peewee import JOIN
+from .models import Song, SongList, MusicFile
+from .os_util import ensure_dir, atomic_write
+
+
+lg = logging.getLogger('xiami.playlist')
+
+
+FORMATS = ['m3u8', 'xspf']
+
+
+class Entry(NamedTuple):
+    song_id: int
+    name: str
+    artist_name: str
+    album_name: str
+    # path relative to music dir, empty if the song is not downloaded
+    path: str
+
+
+def query_song_lists(list_type) -> Dict[int, List[Entry]]:
+    """
+    list_id -> entries in order of the song list, by one query of song_list joined with song and music_file
+    """
+    q = (SongList
+         .select(SongList.list_id, SongList.song_id, Song.name, Song.artist_name, Song.album_name, MusicFile.path)
+         .join(Song, JOIN.LEFT_OUTER, on=(SongList.song_id == Song.id))
+         .join_from(SongList, MusicFile, JOIN.LEFT_OUTER,
+                    on=((MusicFile.song_id == SongList.song_id) & (MusicFile.dir == '')))
+         .where(SongList.list_type == list_type)
+         .order_by(SongList.list_id, SongList.position, SongList.id)
+         .tuples())
+    lists = {}
+    for list_id, rows in groupby(q, key=lambda row: row[0]):
+        entries = []
+        seen = set()
+        for _, song_id, name, artist_name, album_name, path in rows:
+            # a song may have more than one file, e.g. an mp3 and an m4a
+            if song_id in seen:
+                continue
+            seen.add(song_id)
+            entries.append(Entry(song_id, name or '', artist_name or '', album_name or '', path or ''))
+        lists[list_id] = entries
+    return lists
+
+
+def get_file_name(list_id, name, fmt):
+    # `/` is not allowed in file names
+    name = name.replace('/', '_')
+    return f'{list_id}-{name}.{fmt}' if name else f'{list_id}.{fmt}'
+
+
+def render_m3u8(title, entries: List[Entry], rel_dir) -> str:
+    lines = ['#EXTM3U', f'#PLAYLIST:{title}']
+    for entry in entries:
+        if not entry.path:
+            lines.append(f'# not downloaded: {entry.song_id} {entry.artist_name} - {entry.name}')
+            continue
+        lines.append(f'#EXTINF:-1,{entry.artist_name} - {entry.name}')
+        lines.append(f'{rel_dir}/{entry.path}')
+    return '\n'.join(lines) + '\n'
+
+
+def render_xspf(title, entries: List[Entry], rel_dir) -> str:
+    import xml.etree.ElementTree as ET
+
+    playlist = ET.Element('playlist', version='1', xmlns='http://xspf.org/ns/0/')
+    ET.SubElement(playlist, 'title').text = title
+    track_list = ET.SubElement(playlist, 'trackList')
+    for entry in entries:
+        if not entry.path:
+            continue
+        track = ET.SubElement(track_list, 'track')
+        # location is a relative URI
+        ET.SubElement(track, 'location').text = quote(f'{rel_dir}/{entry.path}')
+        ET.SubElement(track, 'title').text = entry.name
+        ET.SubElement(track, 'creator').text = entry.artist_name
+        ET.SubElement(track, 'album').text = entry.album_name
+    ET.indent(playlist)
+    return '<?xml version="1.0" encoding="UTF-8"?>\n' + ET.tostring(playlist, encoding='unicode') + '\n'
+
+
+RENDERERS = {
+    'm3u8': render_m3u8,
+    'xspf': render_xspf,
+}
+
+
+def write_playlists(list_type, names: Dict[int, str], out_dir, music_dir, formats=('m3u8',), dry_run=False):
+    """
+    Write a playlist file of each format for song lists of list_type in out_dir,
+    files that are not changed are not written. Returns (paths of files written, number of files unchanged).
+
+    dry_run: only returns the files that would be written
+    """
+    if not dry_run:
+        ensure_dir(out_dir)
+    rel_dir = os.path.relpath(music_dir, out_dir).replace(os.sep, '/')
+    written, unchanged = [], 0
+    for list_id, entries in query_song_lists(list_type).items():
+        name = names.get(list_id, '')
+        for fmt in formats:
+            content = RENDERERS[fmt](name or str(list_id), entries, rel_dir)
+            file_path = os.path.join(out_dir, get_file_name(list_id, name, fmt))
+            try:
+                with open(file_path, 'r') as f:
+                    if f.read() == content:
+                        unchanged += 1
+                        continue
+            except FileNotFoundError:
+                pass
+            written.append(file_path)
+            if dry_run:
+                continue
+            lg.debug(f'write playlist: {file_path}')
+            atomic_write(file_path, content)
+    return written, unchanged
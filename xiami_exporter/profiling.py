@@ -0,0 +1,72 @@
+"""
+Time named phases of a command (http, json, db, tag, image, disk) with ``span``,
+and profile the whole command with cProfile by the ``--profile`` option.
+
+Spans are inclusive, a span nested in another one is counted in both.
+"""
+import sys
+import time
+import threading
+from contextlib import contextmanager
+
+
+_lock = threading.Lock()
+# phase name -> [count, seconds]
+phases = {}
+
+
+@contextmanager
+def span(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            v = phases.get(name)
+            if v is None:
+                v = phases[name] = [0, 0.0]
+            v[0] += 1
+            v[1] += elapsed
+
+
+def format_phases(wall_time):
+    lines = [f'{"phase":<10}{"count":>10}{"seconds":>12}{"% wall":>9}']
+    for name, (count, seconds) in sorted(phases.items(), key=lambda x: -x[1][1]):
+        percent = seconds / wall_time * 100 if wall_time else 0
+        lines.append(f'{name:<10}{count:>10}{seconds:>12.3f}{percent:>8.1f}%')
+    return '\n'.join(lines)
+
+
+class Profiler:
+    """
+    Run cProfile during a command, dump stats to file_path, which could be read by pstats,
+    snakeviz or converted to a flamegraph by flameprof/gprof2dot, and print a summary to stderr.
+    """
+
+    def __init__(self, file_path, sort='cumulative', limit=25):
+        import cProfile
+
+        self.file_path = file_path
+        self.sort = sort
+        self.limit = limit
+        self.profile = cProfile.Profile()
+        self.start_time = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.profile.enable()
+
+    def stop(self):
+        import pstats
+
+        self.profile.disable()
+        wall_time = time.perf_counter() - self.start_time
+        self.profile.dump_stats(self.file_path)
+
+        out = sys.stderr
+        out.write(f'\nwall time: {wall_time:.3f}s, profile stats: {self.file_path}\n\n')
+        if phases:
+            out.write(format_phases(wall_time) + '\n\n')
+        stats = pstats.Stats(self.profile, stream=out)
+        stats.sort_stats(self.sort).print_stats(self.limit)
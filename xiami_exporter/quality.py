@@ -0,0 +1,67 @@
+import logging
+from typing import Optional, List
+
+
+lg = logging.getLogger('xiami.quality')
+
+
+def get_bitrate(playinfo) -> int:
+    """
+    kbps calculated from fileSize and length (ms), play info has no bitrate field
+    """
+    length = playinfo.get('length') or 0
+    if not length:
+        return 0
+    return int(playinfo['fileSize'] * 8 / length)
+
+
+class QualityPolicy:
+    """
+    Select a play info from the ones returned by getPlayInfo.
+
+    formats: preferred formats in order, e.g. ['mp3', 'm4a'], formats not listed are not used;
+             empty means any format
+    max_bitrate: kbps, 0 means no limit
+    max_file_size: bytes, 0 means no limit
+
+    Among the play infos that satisfy the limits, the preferred format with largest file is selected.
+    If none satisfies the limits, the smallest one is selected, so that the song is still downloaded.
+    """
+
+    def __init__(self, formats: Optional[List[str]] = None, max_bitrate=0, max_file_size=0):
+        self.formats = [i.lower() for i in formats or []]
+        self.max_bitrate = max_bitrate
+        self.max_file_size = max_file_size
+
+    def __str__(self):
+        return f'formats={self.formats or "any"} max_bitrate={self.max_bitrate} max_file_size={self.max_file_size}'
+
+    def format_rank(self, playinfo):
+        if not self.formats:
+            return 0
+        return self.formats.index(playinfo['format'].lower())
+
+    def is_allowed(self, playinfo):
+        if self.max_bitrate and get_bitrate(playinfo) > self.max_bitrate:
+            return False
+        if self.max_file_size and playinfo['fileSize'] > self.max_file_size:
+            return False
+        return True
+
+    def select(self, playinfos) -> Optional[dict]:
+        candidates = [
+            i for i in playinfos
+            if i.get('listenFile') and i['fileSize'] > 0
+            and (not self.formats or (i.get('format') or '').lower() in self.formats)
+        ]
+        if not candidates:
+            return None
+        allowed = [i for i in candidates if self.is_allowed(i)]
+        if not allowed:
+            smallest = min(candidates, key=lambda x: x['fileSize'])
+            lg.debug(f'no play info within limits ({self}), use the smallest one: {smallest["quality"]}')
+            return smallest
+        return sorted(allowed, key=lambda x: (self.format_rank(x), -x['fileSize']))[0]
+
+
+DEFAULT_POLICY = QualityPolicy()
@@ -0,0 +1,93 @@
+import time
+import heapq
+import random
+import logging
+
+
+lg = logging.getLogger('xiami.retry')
+
+
+class RetryPolicy:
+    """
+    Exponential backoff: base_delay * 2 ^ (attempts - 1), capped by max_delay, with a little jitter.
+    """
+
+    def __init__(self, max_attempts=5, base_delay=2, max_delay=600):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempts):
+        """
+        returns seconds to wait before next attempt, or None if attempts are exhausted
+        """
+        if attempts >= self.max_attempts:
+            return None
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        return delay * random.uniform(0.8, 1.2)
+
+
+class RetryScheduler:
+    """
+    In-memory queue of keys waiting for their next attempt, ordered by eligible time.
+    """
+
+    def __init__(self):
+        self.heap = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, key, delay):
+        heapq.heappush(self.heap, (time.time() + delay, key))
+
+    def pop_ready(self, size):
+        keys = []
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now and len(keys) < size:
+            keys.append(heapq.heappop(self.heap)[1])
+        return keys
+
+    def wait(self):
+        """
+        sleep until the first key is eligible
+        """
+        if not self.heap:
+            return
+        seconds = self.heap[0][0] - time.time()
+        if seconds > 0:
+            lg.info(f'wait {seconds:.1f}s for {len(self.heap)} songs to retry')
+            time.sleep(seconds)
+
+
+# status codes of audio/cover cdn that are worth retrying,
+# 403 is also returned when the signed url is expired, which is fixed by getting play info again
+TRANSIENT_STATUS_CODES = [403, 408, 429, 500, 502, 503, 504]
+
+
+def is_transient_error(e: Exception):
+    """
+    Transient errors are retried with backoff, others mean the file is permanently unavailable.
+    """
+    import requests
+    from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+    if isinstance(e, requests.HTTPError):
+        if e.response is None:
+            return True
+        return e.response.status_code in TRANSIENT_STATUS_CODES
+    # only network errors, e.g. InvalidURL or TooManyRedirects are RequestException (an OSError) but permanent
+    return isinstance(e, (
+        requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+        ProtocolError, ReadTimeoutError,
+    ))
+
+
+def is_local_error(e: Exception):
+    """
+    OSError not raised by the network, e.g. disk full, should stop the run instead of marking the file
+    """
+    import requests
+    from urllib3.exceptions import HTTPError as Urllib3Error
+
+    return isinstance(e, OSError) and not isinstance(e, (requests.RequestException, Urllib3Error))
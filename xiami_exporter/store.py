@@ -1,50 +1,336 @@
-from typing import Optional
+from typing import Optional, List, Iterator, Tuple
 from pathlib import Path
-import re
 import os
 import json
 import logging
 from collections import OrderedDict
 from .config import Config
-from .os_util import dir_files_sorted
+from .os_util import ensure_dir, dir_files_sorted, scan_files, atomic_write
+from .archive import JsonArchive
+from .catalog import MusicCatalog
+from .profiling import span
 
 
 lg = logging.getLogger('xiami.store')
 
 
-REGEX_MUSIC_FILE = re.compile(r'^\d+-(\d+)\.')
+def load_json_file(file_path):
+    with span('disk'):
+        with open(file_path, 'r') as f:
+            content = f.read()
+    with span('json'):
+        return json.loads(content)
+
+
+# collections of exported json documents, named by their dirs relative to the json dir
+PAGE_COLLECTIONS = ['songs', 'albums', 'artists', 'playlists', 'my_playlists']
+DETAIL_COLLECTIONS = ['albums/details', 'playlists/details', 'my_playlists/details']
+COLLECTIONS = PAGE_COLLECTIONS + DETAIL_COLLECTIONS
+# collections that are the same for all accounts, stored in the shared dir, see Config.shared_dir
+# -> (page collection of an account that lists the documents it owns, id key of the items in the pages)
+SHARED_COLLECTIONS = {
+    'albums/details': ('albums', 'albumId'),
+}
+
+
+class JsonDirBackend:
+    """
+    One json file per document, json/<collection>/<key>.json, e.g. json/songs/songs-1.json
+    """
+    name = 'dir'
+    # documents are separate files, they could be saved from multiple processes
+    parallel_save = True
+
+    def __init__(self, json_dir):
+        self.json_dir = Path(json_dir)
+
+    def get_path(self, collection, key) -> Path:
+        return self.json_dir.joinpath(collection, f'{key}.json')
+
+    def keys(self, collection) -> List[str]:
+        return [os.path.splitext(i)[0] for i in dir_files_sorted(self.json_dir.joinpath(collection), cached=True)]
+
+    def has(self, collection, key):
+        return self.get_path(collection, key).exists()
+
+    def load(self, collection, key):
+        return load_json_file(self.get_path(collection, key))
+
+    def load_many(self, collection, keys) -> List[object]:
+        return [self.load(collection, key) for key in keys]
+
+    def load_raw(self, collection, key) -> bytes:
+        with open(self.get_path(collection, key), 'rb') as f:
+            return f.read()
+
+    def parse_raw(self, raw: bytes):
+        return json.loads(raw)
+
+    def size(self, collection):
+        return sum(i.stat().st_size for i in scan_files(self.json_dir.joinpath(collection)))
+
+    def save(self, collection, key, data):
+        file_path = self.get_path(collection, key)
+        ensure_dir(file_path.parent)
+        atomic_write(file_path, json.dumps(data, ensure_ascii=False))
+
+    def iter_items(self, collection) -> Iterator[Tuple[str, object]]:
+        for key in self.keys(collection):
+            yield key, self.load(collection, key)
+
+    def compact(self, collection):
+        return 0
+
+
+class JsonArchiveBackend:
+    """
+    A compressed archive per collection, json_archive/<collection>.jsonl.gz, see archive.JsonArchive
+    """
+    name = 'archive'
+    # documents are appended to one file, they must be saved from one process
+    parallel_save = False
+
+    def __init__(self, archive_dir):
+        self.archive_dir = str(archive_dir)
+        self.archives = {}
+
+    def get_archive(self, collection) -> JsonArchive:
+        archive = self.archives.get(collection)
+        if archive is None:
+            archive = self.archives[collection] = JsonArchive(self.archive_dir, collection.replace('/', '_'))
+        return archive
+
+    def keys(self, collection) -> List[str]:
+        return self.get_archive(collection).keys()
+
+    def has(self, collection, key):
+        return key in self.get_archive(collection)
+
+    def load(self, collection, key):
+        return self.get_archive(collection).load(key)
+
+    def load_many(self, collection, keys) -> List[object]:
+        return self.get_archive(collection).load_many(keys)
+
+    def load_raw(self, collection, key) -> bytes:
+        return self.get_archive(collection).load_raw(key)
+
+    def parse_raw(self, raw: bytes):
+        return json.loads(raw)['data']
+
+    def size(self, collection):
+        return self.get_archive(collection).size()
+
+    def save(self, collection, key, data):
+        self.get_archive(collection).save(key, data)
+
+    def iter_items(self, collection) -> Iterator[Tuple[str, object]]:
+        return self.get_archive(collection).iter_items()
+
+    def compact(self, collection):
+        return self.get_archive(collection).compact()
+
+
+class SharedJsonBackend:
+    """
+    Collections in SHARED_COLLECTIONS are stored by the shared backend, others by the backend of the account.
+
+    Only the storage is shared: keys and iter_items of a shared collection are limited to the documents
+    owned by the account, i.e. listed in its own pages, while has and load see documents of all accounts,
+    so a document exported by another account is not fetched again.
+    """
+
+    def __init__(self, backend, shared_backend):
+        self.backend = backend
+        self.shared_backend = shared_backend
+        self.name = backend.name
+        self.parallel_save = backend.parallel_save
+        # shared collection -> keys owned by the account
+        self._owned = {}
+
+    def owned_keys(self, collection) -> set:
+        owned = self._owned.get(collection)
+        if owned is None:
+            page_collection, id_key = SHARED_COLLECTIONS[collection]
+            owned = self._owned[collection] = set(
+                str(item[id_key]) for _, items in self.backend.iter_items(page_collection) for item in items)
+        return owned
+
+    def route(self, collection):
+        if collection in SHARED_COLLECTIONS:
+            return self.shared_backend
+        return self.backend
+
+    def keys(self, collection) -> List[str]:
+        keys = self.route(collection).keys(collection)
+        if collection in SHARED_COLLECTIONS:
+            owned = self.owned_keys(collection)
+            keys = [i for i in keys if i in owned]
+        return keys
+
+    def has(self, collection, key):
+        return self.route(collection).has(collection, key)
+
+    def load(self, collection, key):
+        return self.route(collection).load(collection, key)
+
+    def load_many(self, collection, keys) -> List[object]:
+        return self.route(collection).load_many(collection, keys)
+
+    def load_raw(self, collection, key) -> bytes:
+        return self.route(collection).load_raw(collection, key)
+
+    def parse_raw(self, raw: bytes):
+        return self.backend.parse_raw(raw)
+
+    def size(self, collection):
+        return self.route(collection).size(collection)
+
+    def save(self, collection, key, data):
+        self.route(collection).save(collection, key, data)
+        # pages that list owned documents are changed
+        for shared_collection, (page_collection, _) in SHARED_COLLECTIONS.items():
+            if collection == page_collection:
+                self._owned.pop(shared_collection, None)
+
+    def iter_items(self, collection) -> Iterator[Tuple[str, object]]:
+        if collection not in SHARED_COLLECTIONS:
+            return self.backend.iter_items(collection)
+        return self.iter_owned_items(collection)
+
+    def iter_owned_items(self, collection, chunk_size=100) -> Iterator[Tuple[str, object]]:
+        keys = self.keys(collection)
+        for i in range(0, len(keys), chunk_size):
+            chunk = keys[i:i + chunk_size]
+            yield from zip(chunk, self.shared_backend.load_many(collection, chunk))
+
+    def compact(self, collection):
+        return self.route(collection).compact(collection)
+
+
+def make_json_backend(name, json_dir, json_archive_dir):
+    if name == JsonDirBackend.name:
+        return JsonDirBackend(json_dir)
+    elif name == JsonArchiveBackend.name:
+        return JsonArchiveBackend(json_archive_dir)
+    raise ValueError(f'unknown json backend: {name}')
+
+
+def get_json_backend(cfg: Config, name=None, shared_name=None):
+    """
+    name: layout of the json of the account, defaults to cfg.json_backend
+    shared_name: layout of the shared json, defaults to cfg.shared_json_backend, i.e. the top level json_backend
+    """
+    backend = make_json_backend(name or cfg.json_backend, cfg.json_dir, cfg.json_archive_dir)
+    # the default account shares dir_path with other accounts, its details are limited to its own as well
+    if not cfg.accounts and cfg.shared_path == cfg.dir_path:
+        return backend
+    shared_backend = make_json_backend(
+        shared_name or cfg.shared_json_backend, cfg.shared_json_dir, cfg.shared_json_archive_dir)
+    return SharedJsonBackend(backend, shared_backend)
+
+
+def project_songs(songs, fields=None):
+    """
+    Songs with only keys in fields, so that the rest of the raw dicts could be freed, all keys are kept if fields is None
+    """
+    if fields is None:
+        return songs
+    return [{k: song.get(k) for k in fields} for song in songs]
+
+
+def map_key_chunks(fn, groups: List[Tuple[str, List[str]]], workers=0, chunk_size=0) -> Iterator:
+    """
+    Split keys of each (collection, keys) group into chunks, yields fn(collection, chunk) in the order of chunks,
+    so that the result is the same as processing sequentially. fn is called in a process pool if workers > 1,
+    it must be picklable, e.g. a module level function or a functools.partial of it.
+
+    chunk_size: 0 means each worker gets about 4 chunks, 100 keys a chunk when processing sequentially
+    """
+    total = sum(len(keys) for _, keys in groups)
+    # more processes than cpus only adds the cost of passing documents and results between processes
+    workers = min(workers, os.cpu_count() or 1)
+    if not chunk_size:
+        chunk_size = max(1, total // (workers * 4)) if workers > 1 else 100
+    chunks = []
+    for collection, keys in groups:
+        for i in range(0, len(keys), chunk_size):
+            chunks.append((collection, keys[i:i + chunk_size]))
+    workers = min(workers, len(chunks))
+    if workers <= 1:
+        for collection, keys in chunks:
+            yield fn(collection, keys)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
+
+    lg.debug(f'{total} json documents in {len(chunks)} chunks by {workers} workers')
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fn, collection, keys) for collection, keys in chunks]
+        for future in futures:
+            yield future.result()
+
+
+def load_songs_chunk(docs, collection, keys, fields=None):
+    """
+    Returns songs in the documents of keys, runs in a worker process of the parallel loader.
+    """
+    songs = []
+    for data in docs.load_many(collection, keys):
+        if collection in DETAIL_COLLECTIONS:
+            songs.extend(project_songs(data['songs'], fields))
+        else:
+            songs.extend(project_songs(data, fields))
+    return songs
 
 
 class FileStore:
     def __init__(self, cfg: Config):
         self.cfg = cfg
 
-    def load_song_json(self, file_path, songs_dict: OrderedDict, str_id_dict=None):
-        with open(file_path, 'r') as f:
-            data = json.loads(f.read())
-        for song in data:
+    @property
+    def json_docs(self):
+        """
+        Backend of exported json documents, selected by cfg.json_backend
+        """
+        docs = getattr(self, '_json_docs', None)
+        if not docs:
+            docs = self._json_docs = get_json_backend(self.cfg)
+        return docs
+
+    def load_all_song_json(self, str_id_dict=None, workers=None, fields=None):
+        """
+        Songs in song pages, then songs in details, a song that appears again overrides the previous one.
+
+        workers: number of processes to load json in parallel, defaults to cfg.json_workers,
+                 0 or 1 means loading in the current process
+        fields: only keep these keys (and songId, songStringId) of songs, which saves memory of large libraries
+        """
+        if workers is None:
+            workers = self.cfg.json_workers
+        if fields is not None:
+            fields = ['songId', 'songStringId'] + [i for i in fields if i not in ('songId', 'songStringId')]
+        songs_dict = OrderedDict()
+        for song in self.iter_all_songs(workers, fields):
             songs_dict[song['songId']] = song
             if str_id_dict is not None:
                 str_id_dict[song['songStringId']] = song
+        return songs_dict
 
-    def load_all_song_json(self, str_id_dict=None):
-        cfg = self.cfg
-        songs_dict = OrderedDict()
+    def iter_all_songs(self, workers=0, fields=None):
+        from functools import partial
 
-        # read all song json files
-        for file_name in dir_files_sorted(cfg.json_songs_dir):
-            self.load_song_json(cfg.json_songs_dir.joinpath(file_name), songs_dict, str_id_dict)
-
-        # read from details dir
-        for details_dir in [cfg.json_albums_details_dir, cfg.json_playlists_details_dir, cfg.json_my_playlists_details_dir]:
-            for file_name in dir_files_sorted(details_dir):
-                with open(details_dir.joinpath(file_name), 'r') as f:
-                    detail = json.loads(f.read())
-                for song_data in detail['songs']:
-                    songs_dict[song_data['songId']] = song_data
-                    if str_id_dict is not None:
-                        str_id_dict[song_data['songStringId']] = song_data
-        return songs_dict
+        docs = self.json_docs
+        groups = [(collection, docs.keys(collection)) for collection in ['songs'] + DETAIL_COLLECTIONS]
+        for songs in map_key_chunks(partial(load_songs_chunk, docs, fields=fields), groups, workers):
+            yield from songs
+
+    @property
+    def catalog(self) -> MusicCatalog:
+        catalog = getattr(self, '_catalog', None)
+        if not catalog:
+            catalog = self._catalog = MusicCatalog(self.cfg.music_dir)
+        return catalog
 
     def load_music_files(self, dir_path=None):
         files_dict = {}
@@ -53,30 +339,30 @@ class FileStore:
         return files_dict
 
     def yield_music_files(self, dir_path=None, recurse=False):
-        if not dir_path:
-            dir_path = self.cfg.music_dir
-        for _dir_path, _, file_names in os.walk(dir_path):
-            lg.info(f'walk dir: {_dir_path}')
-            for file_name in file_names:
-                if file_name.endswith('.json'):
-                    # skip .json files
-                    continue
-                rv = REGEX_MUSIC_FILE.search(file_name)
-                if not rv:
-                    lg.info(f'file {file_name}: skip for name not match ROW_NUMBER-SONG_ID.mp3 file pattern')
-                    continue
-                song_id = int(rv.groups()[0])
-                yield file_name, Path(_dir_path).joinpath(file_name), song_id
-            if not recurse:
-                break
+        """
+        Yields (file_name, file_path, song_id) from the music file catalog, database must be prepared.
+        """
+        catalog = self.catalog
+        catalog.refresh(dir_path=dir_path, recurse=recurse)
+        for mf in catalog.iter_files(dir_path=dir_path, recurse=recurse):
+            yield mf.file_name, catalog.get_path(mf), mf.song_id
+
+    def find_music_file(self, song_id) -> Optional[Path]:
+        catalog = self.catalog
+        mf = catalog.find(song_id)
+        # scan music dir only when the entry is missing or stale
+        if not mf or not catalog.is_current(mf):
+            catalog.refresh()
+            mf = catalog.find(song_id)
+        if mf:
+            return catalog.get_path(mf)
 
     def find_cover_file(self, album_id) -> Optional[Path]:
         cover_files_dict = getattr(self, 'cover_files_dict', None)
-        if not cover_files_dict:
+        if cover_files_dict is None:
             cover_files_dict = {}
-            for _, _, files in os.walk(self.cfg.covers_dir):
-                for file_name in files:
-                    cover_files_dict[Path(file_name).stem] = file_name
+            for entry in scan_files(self.cfg.covers_dir):
+                cover_files_dict[os.path.splitext(entry.name)[0]] = entry.name
             self.cover_files_dict = cover_files_dict
 
         file_name = cover_files_dict.get(str(album_id))
@@ -0,0 +1,87 @@
+"""
+Trim useless keys in exported json documents, keys are listed in client.song_useless_keys and client.album_useless_keys.
+"""
+import logging
+from functools import partial
+from typing import List, Tuple
+from .client import trim_song, trim_album, song_useless_keys, album_useless_keys
+from .store import map_key_chunks
+
+
+lg = logging.getLogger('xiami.trim')
+
+
+# collections whose documents contain songs, page collections other than songs are kept as they are
+TRIM_COLLECTIONS = ['songs', 'albums/details', 'playlists/details', 'my_playlists/details']
+
+USELESS_MARKERS = [f'"{k}":'.encode() for k in sorted(set(song_useless_keys + album_useless_keys))]
+
+
+def needs_trim(raw: bytes):
+    """
+    Cheap check on raw json, documents without any useless key are skipped without parsing.
+
+    A match could be false, e.g. the key is in a string value, then trim_doc finds nothing to trim.
+    """
+    return any(marker in raw for marker in USELESS_MARKERS)
+
+
+def trim_doc(collection, data):
+    """
+    Trim the document in place, returns True if it is changed
+    """
+    changed = False
+    if collection == 'songs':
+        songs = data
+    else:
+        songs = data['songs']
+        if collection == 'albums/details':
+            changed = trim_album(data)
+    for song in songs:
+        changed = trim_song(song) or changed
+    return changed
+
+
+def trim_chunk(docs, collection, keys) -> Tuple[List[str], list]:
+    """
+    Trim documents of keys, runs in a worker process of trim_collection.
+
+    Returns (keys of trimmed documents, [(key, data), ...] of trimmed documents that are not saved),
+    documents are saved here if the backend could be saved from multiple processes,
+    otherwise they are returned to be saved by the caller.
+    """
+    trimmed, unsaved = [], []
+    for key in keys:
+        raw = docs.load_raw(collection, key)
+        if not needs_trim(raw):
+            continue
+        data = docs.parse_raw(raw)
+        if not trim_doc(collection, data):
+            continue
+        trimmed.append(key)
+        if docs.parallel_save:
+            docs.save(collection, key, data)
+        else:
+            unsaved.append((key, data))
+    return trimmed, unsaved
+
+
+def trim_collection(docs, collection, workers=0, chunk_size=100):
+    """
+    Returns (number of documents, number of trimmed documents, bytes before, bytes after)
+    """
+    keys = docs.keys(collection)
+    size_before = docs.size(collection)
+
+    trimmed = 0
+    # saving documents here only replaces values of existing keys in the archive index,
+    # chunks still waiting to be sent read the same documents
+    for chunk_trimmed, unsaved in map_key_chunks(partial(trim_chunk, docs), [(collection, keys)], workers, chunk_size):
+        trimmed += len(chunk_trimmed)
+        for key, data in unsaved:
+            docs.save(collection, key, data)
+
+    if trimmed:
+        # drop documents replaced by saving again
+        docs.compact(collection)
+    return len(keys), trimmed, size_before, docs.size(collection)
@@ -0,0 +1,178 @@
+"""
+Integrity checks for downloaded audio files.
+
+A truncated download ends in the middle of an mp3 frame or an mp4 atom,
+so the files are checked by walking their frame/atom structure, and then parsed by mutagen.
+"""
+import os
+import mmap
+import struct
+import logging
+from typing import Optional
+
+
+lg = logging.getLogger('xiami.verify')
+
+
+# kbps, indexed by bitrate index
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# version bits -> (version for bitrate table, sample rates)
+MP3_VERSIONS = {
+    0b11: (1, [44100, 48000, 32000]),  # MPEG 1
+    0b10: (2, [22050, 24000, 16000]),  # MPEG 2
+    0b00: (2, [11025, 12000, 8000]),  # MPEG 2.5
+}
+
+# layer bits -> layer
+MP3_LAYERS = {0b11: 1, 0b10: 2, 0b01: 3}
+
+
+def mp3_frame_length(header: bytes) -> Optional[int]:
+    """
+    returns frame length in bytes, or None if header is not a valid frame header
+    """
+    b1, b2 = header[1], header[2]
+    if header[0] != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+    version_bits = (b1 >> 3) & 0b11
+    layer = MP3_LAYERS.get((b1 >> 1) & 0b11)
+    if version_bits not in MP3_VERSIONS or not layer:
+        return None
+    bitrate_index = b2 >> 4
+    sample_rate_index = (b2 >> 2) & 0b11
+    if bitrate_index in (0, 0xF) or sample_rate_index == 0b11:
+        # free format is not supported
+        return None
+    version, sample_rates = MP3_VERSIONS[version_bits]
+    bitrate = MP3_BITRATES[(version, layer)][bitrate_index] * 1000
+    sample_rate = sample_rates[sample_rate_index]
+    padding = (b2 >> 1) & 1
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4
+    if layer == 3 and version == 2:
+        return 72 * bitrate // sample_rate + padding
+    return 144 * bitrate // sample_rate + padding
+
+
+def mp3_audio_range(buf):
+    """
+    returns (start, end) of audio frames, excluding ID3v2, ID3v1 and APEv2 tags
+    """
+    start, end = 0, len(buf)
+    if buf[:3] == b'ID3' and end >= 10:
+        size = 0
+        for b in buf[6:10]:
+            size = (size << 7) | (b & 0x7F)
+        start = 10 + size
+        if buf[5] & 0x10:
+            # footer present
+            start += 10
+    if end - start >= 128 and buf[end - 128:end - 125] == b'TAG':
+        end -= 128
+    if end - start >= 32 and buf[end - 32:end - 24] == b'APETAGEX':
+        tag_size, flags = struct.unpack('<II', buf[end - 20:end - 12])
+        end -= tag_size
+        if flags & 0x80000000:
+            # header present
+            end -= 32
+    return start, end
+
+
+def check_mp3_frames(buf) -> Optional[str]:
+    start, end = mp3_audio_range(buf)
+    pos = start
+    frames = 0
+    while pos + 4 <= end:
+        length = mp3_frame_length(buf[pos:pos + 4])
+        if not length:
+            # lost sync, could be junk data between frames, find next frame header
+            next_pos = buf.find(b'\xff', pos + 1, end)
+            if next_pos < 0:
+                break
+            pos = next_pos
+            continue
+        if pos + length > end:
+            return f'truncated: last frame needs {pos + length - end} more bytes'
+        frames += 1
+        pos += length
+    if not frames:
+        return 'no mpeg audio frames found'
+    return None
+
+
+def check_mp4_atoms(buf) -> Optional[str]:
+    size = len(buf)
+    pos = 0
+    atoms = set()
+    while pos + 8 <= size:
+        atom_size, atom_type = struct.unpack('>I4s', buf[pos:pos + 8])
+        if atom_size == 1:
+            if pos + 16 > size:
+                return 'truncated: incomplete atom header'
+            atom_size = struct.unpack('>Q', buf[pos + 8:pos + 16])[0]
+        elif atom_size == 0:
+            # extends to end of file
+            atom_size = size - pos
+        if atom_size < 8:
+            return f'invalid atom size {atom_size} at {pos}'
+        if pos + atom_size > size:
+            return f'truncated: atom {atom_type!r} needs {pos + atom_size - size} more bytes'
+        atoms.add(atom_type)
+        pos += atom_size
+    if pos != size:
+        return 'truncated: incomplete atom header'
+    for i in (b'moov', b'mdat'):
+        if i not in atoms:
+            return f'atom {i!r} not found'
+    return None
+
+
+def load_mutagen(file_path, ext):
+    if ext == '.mp3':
+        from mutagen.mp3 import MP3
+        return MP3(file_path)
+    elif ext == '.m4a':
+        from mutagen.mp4 import MP4
+        return MP4(file_path)
+
+
+def verify_file(file_path, expected_size=0):
+    """
+    Returns (file_path, size, problem), problem is None if the file is ok.
+
+    expected_size is the fileSize from play info, it's only compared for files without tags,
+    as tagging changes the file size.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    size = os.path.getsize(file_path)
+    if size == 0:
+        return file_path, size, 'empty file'
+
+    with open(file_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        if ext == '.mp3':
+            problem = check_mp3_frames(buf)
+        elif ext == '.m4a':
+            problem = check_mp4_atoms(buf)
+        else:
+            return file_path, size, None
+    if problem:
+        return file_path, size, problem
+
+    try:
+        obj = load_mutagen(file_path, ext)
+    except Exception as e:
+        return file_path, size, f'mutagen error: {e!r}'
+    if not obj.info.length:
+        return file_path, size, 'zero length'
+
+    if expected_size and size != expected_size and not obj.tags:
+        return file_path, size, f'size mismatch: {size} != {expected_size}'
+    return file_path, size, None
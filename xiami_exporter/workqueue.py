@@ -0,0 +1,21 @@
+import heapq
+import itertools
+
+
+class WorkQueue:
+    """
+    Tasks are popped by priority, lower first, tasks of the same priority are popped in order of pushing.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.counter = itertools.count()
+
+    def push(self, priority, task):
+        heapq.heappush(self.heap, (priority, next(self.counter), task))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+    def __len__(self):
+        return len(self.heap)